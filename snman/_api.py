@@ -13,9 +13,13 @@ from .io import export_gdf
 from .io import import_geofile_to_gdf
 from .io import convert_crs_of_street_graph
 from .io import export_osm_xml
+from .io import export_osm_pbf
 from .io import load_perimeters
 from .io import load_regions
 from .io import load_intersections
+from .io import save_snapshot
+from .io import load_snapshot
+from .io import open_snapshot
 
 from .hierarchy import add_hierarchy
 
@@ -30,6 +34,7 @@ from .distribution import set_given_lanes
 from .distribution import create_given_lanes_graph
 
 from .geometry_tools import remove_multipart_geometries
+from .geometry_tools import simplify_edge_geometries
 
 from .simplification import consolidate_intersections
 
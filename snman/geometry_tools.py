@@ -1,7 +1,7 @@
 import networkx as nx
 import shapely as shp
 import numpy as np
-import math
+import multiprocessing as mp
 
 
 def remove_multipart_geometries(G):
@@ -20,29 +20,111 @@ def remove_multipart_geometries(G):
     None
     """
 
-    for id, data in G.edges.items():
-        geom = data.get('geometry', None)
-        if not isinstance(geom, shp.geometry.linestring.LineString):
-            start_node = G.nodes.items()[id[0]]
-            end_node = G.nodes.items()[id[1]]
-            simple_line = shp.geometry.LineString(
-                shp.geometry.Point(
-                    start_node.get('x',0),
-                    start_node.get('y',0)
-                ),
-                shp.geometry.Point(
-                    end_node.get('x', 0),
-                    end_node.get('y', 0)
-                )
-            )
-            data['geometry'] = simple_line
+    edges = list(G.edges(data=True))
+    if len(edges) == 0:
+        return
+
+    geometries = np.array([data.get('geometry') for u, v, data in edges], dtype=object)
+    # type id 1 = LineString, missing geometries have type id -1
+    not_linestring = np.flatnonzero(shp.get_type_id(geometries) != 1)
+    if len(not_linestring) == 0:
+        return
+
+    # build all the replacement lines from the node coordinates at once
+    coords = np.array([
+        [
+            (G.nodes[edges[i][0]].get('x', 0), G.nodes[edges[i][0]].get('y', 0)),
+            (G.nodes[edges[i][1]].get('x', 0), G.nodes[edges[i][1]].get('y', 0)),
+        ]
+        for i in not_linestring
+    ], dtype=float)
+    simple_lines = shp.linestrings(coords)
+
+    for i, simple_line in zip(not_linestring, simple_lines):
+        edges[i][2]['geometry'] = simple_line
+
+
+def _simplify_geometries(geometries, tolerance, preserve_topology):
+    """
+    Simplify an array of geometries and calculate their lengths (for multiprocessing)
+
+    Parameters
+    ----------
+    geometries : np.ndarray
+    tolerance : float
+    preserve_topology : bool
+
+    Returns
+    -------
+    tuple
+        simplified geometries, lengths
+    """
+
+    geometries = shp.simplify(geometries, tolerance, preserve_topology=preserve_topology)
+    return geometries, shp.length(geometries)
+
+
+def simplify_edge_geometries(G, tolerance, preserve_topology=False, cpus=1, chunk_size=100000):
+    """
+    Simplify the geometries of all edges in one vectorised operation and update their lengths
+
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    tolerance : float
+        see shapely.simplify
+    preserve_topology : bool
+        see shapely.simplify
+    cpus : int
+        how many CPU cores to use; if None, use all available
+    chunk_size : int
+        number of edges processed together on one CPU core, only used if cpus > 1
+
+    Returns
+    -------
+    None
+    """
+
+    edges_data = [data for u, v, data in G.edges(data=True) if data.get('geometry') is not None]
+    if len(edges_data) == 0:
+        return
+
+    geometries = np.array([data['geometry'] for data in edges_data], dtype=object)
+
+    if cpus is None:
+        cpus = mp.cpu_count()
+    cpus = min(cpus, mp.cpu_count())
+
+    if cpus == 1 or len(geometries) <= chunk_size:
+        geometries, lengths = _simplify_geometries(geometries, tolerance, preserve_topology)
+    else:
+        args = (
+            (geometries[i : i + chunk_size], tolerance, preserve_topology)
+            for i in range(0, len(geometries), chunk_size)
+        )
+        pool = mp.Pool(cpus)
+        sma = pool.starmap_async(_simplify_geometries, args)
+        results = sma.get()
+        pool.close()
+        pool.join()
+        geometries = np.concatenate([result[0] for result in results])
+        lengths = np.concatenate([result[1] for result in results])
+
+    for data, geometry, length in zip(edges_data, geometries, lengths.tolist()):
+        data['geometry'] = geometry
+        data['length'] = length
 
 
 def _offset_distance(linestrings):
     """
     Takes a set of linestrings and calculates the average offset for each of them.
     This is useful for detecting the order of approximately parallel edges geometries that should be merged into
-    a single street.
+    a single street, and for detecting edges that are too far apart to be merged.
+
+    The offset is measured from an axis between the start and end point of the first geometry: 10 points
+    are sampled along each linestring and their distance from the axis is projected onto the axis normal
+    (positive = left of the axis) and averaged.
 
     Parameters
     ----------
@@ -55,39 +137,30 @@ def _offset_distance(linestrings):
         a list of the calculated offsets
     """
 
+    linestrings = np.asarray(linestrings, dtype=object)
+
     # Start and end point of axis based on the first geometry
-    u = shp.ops.Point(linestrings[0].coords[0])
-    v = shp.ops.Point(linestrings[0].coords[-1])
-    axis = shp.ops.LineString([u,v])
+    u = np.array(linestrings[0].coords[0][0:2])
+    v = np.array(linestrings[0].coords[-1][0:2])
+    axis_vector = v - u
+    axis_length = np.hypot(*axis_vector)
 
-    # check if the axis vector is in quadrant 2 or 3 (in these cases, we need to add 180deg to the value of arctan)
-    quadrants_23 = v.x - u.x < 0
+    # The offsets are undefined if the first geometry is closed
+    if axis_length == 0:
+        return [0.0] * len(linestrings)
 
-    # Points at which we will measure the distance between axis and each geometry
-    measurement_points = [axis.interpolate(step, normalized=True) for step in np.arange(0,1,0.1)]
-    axis_angle = math.degrees(np.arctan((v.y - u.y) / (v.x - u.x)))
+    # Unit normal vector pointing to the left of the axis
+    normal = np.array([-axis_vector[1], axis_vector[0]]) / axis_length
 
-    offsets = []
+    # Sample points along each linestring (rows), at the same relative positions (columns)
+    steps = np.arange(0.05, 1, 0.1)
+    sample_points = shp.line_interpolate_point(linestrings[:, np.newaxis], steps[np.newaxis, :], normalized=True)
+    sample_xy = shp.get_coordinates(sample_points.ravel()).reshape(len(linestrings), len(steps), 2)
 
-    for linestring in linestrings:
-        nearest_points = [shp.ops.nearest_points(measurement_point, linestring)[1] for measurement_point in measurement_points]
-        vectors = [
-            (points_pair[1].x - points_pair[0].x, points_pair[1].y - points_pair[0].y)
-            for points_pair
-            in list(zip(measurement_points, nearest_points))
-        ]
-        diff_vector = np.mean(vectors, axis=0)
-        # rotate the difference vector based on the axis
-        rotated_diff_vector = shp.affinity.rotate(
-            shp.ops.LineString([(0,0), diff_vector]),
-            -(axis_angle + (quadrants_23 * 180)),
-            origin=[0,0]
-        )
-        # take the y coordinate as offset
-        offset = rotated_diff_vector.coords[1][1]
-        offsets.append(offset)
+    # Average distance of the sample points from the axis, projected onto the axis normal
+    offsets = ((sample_xy - u) @ normal).mean(axis=1)
 
-    return offsets
+    return offsets.tolist()
 
 
 def ensure_multipolygon(geometry):
@@ -5,13 +5,20 @@ from shapely.ops import substring
 import shapely
 import shapely.geometry
 import networkx as nx
-import copy
+import numpy as np
 import osmnx
 import geopandas as gpd
 import itertools
+import multiprocessing as mp
 from . import osmnx_customized as oxc
 import statistics as stats
 
+# scipy is an optional dependency for finding the closest nodes between components
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # pragma: no cover
+    cKDTree = None
+
 
 def _calculate_lane_cost(lane, length, mode):
 
@@ -96,6 +103,84 @@ def street_graph_to_lane_graph(G, mode, lanes_attribute=KEY_LANES_DESCRIPTION):
     return L
 
 
+def _connected_component_labels(G, strongly=False):
+    """
+    Map every node to the id of its connected component.
+
+    Weakly connected components (and components of undirected graphs) are found with a single union-find pass
+    over the edges. Strongly connected components are found with the Tarjan-based implementation of networkx.
+
+    Parameters
+    ----------
+    G : nx.MultiDiGraph or nx.MultiGraph
+    strongly : bool
+        use strongly connected components, only for directed graphs
+
+    Returns
+    -------
+    dict
+        node id -> component id, components are numbered consecutively starting from 0
+    """
+
+    if strongly:
+        return {
+            node: component
+            for component, nodes in enumerate(nx.strongly_connected_components(G))
+            for node in nodes
+        }
+
+    return _union_find_labels(G.nodes, G.edges())
+
+
+def _union_find_labels(nodes, edges):
+    """
+    Label nodes by the connected components that the given edges form between them, using union-find.
+    Edges with a node that is not in nodes are ignored.
+
+    Parameters
+    ----------
+    nodes : iterable
+        node ids
+    edges : iterable
+        (u, v, ...) tuples
+
+    Returns
+    -------
+    dict
+        node id -> component id, components are numbered consecutively in the order of their first node
+    """
+
+    parent = {node: node for node in nodes}
+
+    def find(node):
+        root = node
+        while parent[root] != root:
+            root = parent[root]
+        # path compression
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    for edge in edges:
+        u, v = edge[0], edge[1]
+        if u not in parent or v not in parent:
+            continue
+        root_u = find(u)
+        root_v = find(v)
+        if root_u != root_v:
+            parent[root_v] = root_u
+
+    component_ids = {}
+    labels = {}
+    for node in parent:
+        root = find(node)
+        if root not in component_ids:
+            component_ids[root] = len(component_ids)
+        labels[node] = component_ids[root]
+
+    return labels
+
+
 def add_connected_component_ids(G):
     """
     For directed graphs: Adds IDs of weakly ('_weakly_connected_component')
@@ -107,30 +192,36 @@ def add_connected_component_ids(G):
     G : nx.MultiDiGraph or nx.MultiGraph
     Returns
     -------
-    None
+    component_ids : dict
+        attribute name -> {node id: component id}, can be passed to keep_only_the_largest_connected_component
+        so that the components are not computed again
     """
 
     if G.is_directed():
-
-        wccs = nx.weakly_connected_components(G)
-        for wcc, nodes in enumerate(wccs):
-            subgraph = nx.subgraph(G, nodes)
-            nx.set_edge_attributes(subgraph, wcc, '_weakly_connected_component')
-
-        sccs = nx.strongly_connected_components(G)
-        for scc, nodes in enumerate(sccs):
-            subgraph = nx.subgraph(G, nodes)
-            nx.set_edge_attributes(subgraph, wcc, '_strongly_connected_component')
-
+        component_ids = {
+            '_weakly_connected_component': _connected_component_labels(G),
+            '_strongly_connected_component': _connected_component_labels(G, strongly=True),
+        }
     else:
+        component_ids = {
+            '_connected_component': _connected_component_labels(G),
+        }
+
+    for attribute, labels in component_ids.items():
+        if attribute == '_strongly_connected_component':
+            # an edge is only part of a strongly connected component if both of its nodes are,
+            # the attribute is not set on the other edges
+            for u, v, data in G.edges(data=True):
+                if labels[u] == labels[v]:
+                    data[attribute] = labels[u]
+        else:
+            for u, v, data in G.edges(data=True):
+                data[attribute] = labels[u]
 
-        ccs = nx.connected_components(G)
-        for wcc, nodes in enumerate(ccs):
-            subgraph = nx.subgraph(G, nodes)
-            nx.set_edge_attributes(subgraph, wcc, '_connected_component')
+    return component_ids
 
 
-def keep_only_the_largest_connected_component(G, weak=False):
+def keep_only_the_largest_connected_component(G, weak=False, component_ids=None):
     """
     Remove all nodes and edges that are disconnected from the largest connected component.
     For directed graphs, strong connectedness will be considered, unless weak=True
@@ -141,6 +232,9 @@ def keep_only_the_largest_connected_component(G, weak=False):
         street graph
     weak : bool
         use weakly connected component in case of a directed graph
+    component_ids : dict
+        optional, the result of add_connected_component_ids,
+        avoids computing the connected components again
 
     Returns
     -------
@@ -148,113 +242,98 @@ def keep_only_the_largest_connected_component(G, weak=False):
     """
 
     if G.is_directed():
-        if weak:
-            nodes = max(nx.weakly_connected_components(G), key=len)
-        else:
-            nodes = max(nx.strongly_connected_components(G), key=len)
+        attribute = '_weakly_connected_component' if weak else '_strongly_connected_component'
     else:
-        nodes = max(nx.connected_components(G), key=len)
-
-    return G.subgraph(nodes).copy()
+        attribute = '_connected_component'
 
+    if component_ids is not None and attribute in component_ids:
+        labels = component_ids[attribute]
+    else:
+        labels = _connected_component_labels(G, strongly=G.is_directed() and not weak)
 
-def _edge_hash(edge):
-    """
-    Generate a unique string id for an edge
-    TODO: Use the tuple instead
-
-    Parameters
-    ----------
-    edge : tuple
-        the complete tuple of an edge
+    if len(labels) == 0:
+        return G.copy()
 
-    Returns
-    -------
-    str
-    """
+    # count the nodes in each component and keep the largest one
+    sizes = {}
+    for component in labels.values():
+        sizes[component] = sizes.get(component, 0) + 1
+    largest = max(sizes, key=sizes.get)
+    nodes = [node for node, component in labels.items() if component == largest]
 
-    return '-'.join(map(str, edge[0:3]))
+    return G.subgraph(nodes).copy()
 
 
-def _remove_edge_from_list(edges, edge_to_remove, dead_ends=True):
+def _edge_key(edge, directed=True):
     """
-    Remove edge from a list using its unique string id
+    Generate a unique tuple key for an edge, for indexing and comparing edges without building strings.
+    In undirected graphs, the same edge can be reported as (u, v, key) or (v, u, key), so the nodes are ordered
 
     Parameters
     ----------
-    edges : list
-    edge_to_remove : tuple
-    dead_ends : bool
-        include dead ends in the resulting list
+    edge : tuple
+        the complete tuple of an edge, or at least (u, v, key)
+    directed : bool
+        whether the edge belongs to a directed graph
 
     Returns
     -------
-    list
+    tuple
     """
 
-    edges_cleaned = []
-    for idx, candidate in enumerate(edges):
-        if (_edge_hash(candidate) != _edge_hash(edge_to_remove)
-                and not (not dead_ends and candidate[3].get('dead_end'))):
-            edges_cleaned.append(candidate)
-    return edges_cleaned
+    u, v, key = edge[0:3]
+    if not directed and u > v:
+        return v, u, key
+    return u, v, key
 
 
-def _get_neighbors(G, edge, dead_ends=True):
+def _reserve_node_ids(G, n=1):
     """
-    Return the neighbor edges of a given edge. The result is a list of three lists:
-        * neighbors at the side of u node
-        * neighbors at the side of v node
-        * neighbors from both sides
+    Reserve ids for new nodes in a graph, without searching the maximum node id every time.
+    The next free id is kept in the graph attribute '_next_node_id'; ids that are already
+    in use (e.g. nodes added by other means) are skipped.
 
     Parameters
     ----------
-    G : nx.MultiGraph
-        street graph
-    edge : tuple
-        the complete tuple of an edge
-    dead_ends : bool
-        include dead ends int the results
+    G : nx.MultiGraph or nx.MultiDiGraph
+    n : int
+        how many ids should be reserved
 
     Returns
     -------
     list
-        a list of edges
+        new node ids
     """
 
-    adjacent_nodes = edge[0:2]
-    u_neighbors = list(G.edges(nbunch=adjacent_nodes[0], data=True, keys=True))
-    v_neighbors = list(G.edges(nbunch=adjacent_nodes[1], data=True, keys=True))
-    # Remove this edge from the neighbors
-    u_neighbors = _remove_edge_from_list(u_neighbors, edge, dead_ends=dead_ends)
-    v_neighbors = _remove_edge_from_list(v_neighbors, edge, dead_ends=dead_ends)
-    return [
-        _unique_edges(u_neighbors),
-        _unique_edges(v_neighbors),
-        _unique_edges(u_neighbors + v_neighbors)
-    ]
+    node_ids = _unused_node_ids(G)
+    reserved = [next(node_ids) for i in range(n)]
+    if reserved:
+        G.graph['_next_node_id'] = reserved[-1] + 1
+    return reserved
 
 
-def _unique_edges(edges):
+def _unused_node_ids(G):
     """
-    Remove duplicates from a list of edges
+    Generate node ids that are not in use in a graph, starting from the graph's next free id.
+    Unlike _reserve_node_ids, this does not update the graph, so it can be used for ids outside the graph
+    (e.g. when exporting)
 
     Parameters
     ----------
-    edges : list
+    G : nx.MultiGraph or nx.MultiDiGraph
 
     Returns
     -------
-    list
+    generator
     """
 
-    unique_edges = []
-    hashes = set()
-    for edge in edges:
-        this_hash = _edge_hash(edge)
-        this_hash in hashes or unique_edges.append(edge)
-        hashes.add(this_hash)
-    return unique_edges
+    node_id = G.graph.get('_next_node_id')
+    if node_id is None:
+        node_id = max(G.nodes, default=-1) + 1
+    while True:
+        if node_id not in G.nodes:
+            yield node_id
+        node_id += 1
 
 
 def organize_edge_directions(G, method='lower_to_higher_node_id'):
@@ -349,9 +428,30 @@ def _reverse_edge(G, edge, reverse_topology=True):
         return edge
 
 
-def _split_edge(G, u, v, key, split_point):
+def _copy_edge_data(edge_data):
+    """
+    Copy the data dictionary of an edge, including one level of nested containers (e.g. lanes and sensors lists),
+    so that the copy can be modified without affecting the original. Geometries are immutable and not copied.
+
+    Parameters
+    ----------
+    edge_data : dict
+
+    Returns
+    -------
+    dict
+    """
+
+    return {
+        key: value.copy() if isinstance(value, (list, set, dict)) else value
+        for key, value in edge_data.items()
+    }
+
+
+def _split_edge(G, u, v, key, split_points, min_distance=1):
     """
-    Split the edge at a given point and create two child edges, together with a new node in between
+    Split the edge at one or more given points and create a chain of child edges, with new nodes in between.
+    The split points are snapped onto the edge geometry and the geometry is cut by linear referencing.
 
     Parameters
     ----------
@@ -363,70 +463,72 @@ def _split_edge(G, u, v, key, split_point):
         edge to be split - v node
     key : int
         edge to be split - key
-    split_point : shapely.geometry.Point
+    split_points : shapely.geometry.Point or list
+        one or multiple points where the edge should be split
+    min_distance : float
+        split points closer than this to the edge ends or to each other are ignored
 
     Returns
     -------
-    None
+    list
+        ids of the new nodes, empty if the edge has not been split
     """
 
     # Don't continue if the edge does not exist
-    if not G.has_edge(u,v,key):
-        #print('edge does not exist:', u, v, key)
-        return False
+    if not G.has_edge(u, v, key):
+        return []
+
+    if isinstance(split_points, shapely.geometry.Point):
+        split_points = [split_points]
 
     edge_data = G.get_edge_data(u, v, key)
+    line = edge_data.get('geometry')
+    has_geometry = isinstance(line, shapely.geometry.LineString) and not line.is_empty
+
+    if has_geometry:
+        # position of each split point along the line, skip those too close to the ends or to each other
+        length = line.length
+        distances = []
+        for distance in sorted(line.project(point) for point in split_points):
+            if distance < min_distance or distance > length - min_distance:
+                continue
+            if distances and distance - distances[-1] < min_distance:
+                continue
+            distances.append(distance)
+        split_points = [line.interpolate(distance) for distance in distances]
+        boundaries = [0] + distances + [length]
+    else:
+        boundaries = None
 
-    # Assign a new node id
-    split_node_id = max(G.nodes) + 1
-
-    # duplicate the existing edge data as a basis for the data of the two new edges
-    edge1_data = copy.deepcopy(edge_data)
-    edge2_data = copy.deepcopy(edge_data)
-
-    # split geometry
-    line = edge_data.get('geometry', False)
-    if line != False:
-        node_point = split_point
-        # snap the split point onto the line
-        split_point = shapely.ops.nearest_points(node_point, line)[1]
-        # Just using the point to split the line does not work because it is not exactly on the line.
-        # So we create a small circle around it
-        split_circle = split_point.buffer(1)
-        new_lines = shapely.ops.split(line, split_circle)
-
-        # Stop if the splitting was not successful
-        if len(new_lines.geoms) != 3:
-            return False
-
-        # Extend the geometries to the split node
-        edge1_data['geometry'] = shapely.ops.LineString(
-            list(new_lines.geoms[0].coords) + list(node_point.coords)
-        )
-        edge1_data['_split'] = 1
-        edge2_data['geometry'] = shapely.ops.LineString(
-            list(node_point.coords) + list(new_lines.geoms[2].coords)
-        )
-        edge2_data['_split'] = 2
+    if len(split_points) == 0:
+        return []
+
+    # Split topology and geometry
+    new_nodes = _reserve_node_ids(G, len(split_points))
+    for node_id, point in zip(new_nodes, split_points):
+        G.add_node(node_id, x=point.x, y=point.y, _split_node=True)
 
-    # Split topology
-    G.add_node(split_node_id, x=split_point.x, y=split_point.y, _split_node=True)
     G.remove_edge(u, v, key)
-    key1 = G.add_edge(u, split_node_id, **edge1_data)
-    key2 = G.add_edge(split_node_id, v, **edge2_data)
+    chain = [u] + new_nodes + [v]
+    for i in range(len(chain) - 1):
+        child_data = _copy_edge_data(edge_data)
+        child_data['_split'] = i + 1
+        if has_geometry:
+            child_data['geometry'] = substring(line, boundaries[i], boundaries[i + 1])
+            child_data['length'] = child_data['geometry'].length
+        child_key = G.add_edge(chain[i], chain[i + 1], **child_data)
+
+        # Reverse the new edge data if the new node has changed their topological direction
+        if not nx.is_directed(G) and chain[i] > chain[i + 1]:
+            _reverse_edge(G, (chain[i], chain[i + 1], child_key, G.edges[chain[i], chain[i + 1], child_key]))
 
-    # Reverse the new edge data if the new node has changed their topological direction
-    if not nx.is_directed(G):
-        if u > split_node_id:
-            _reverse_edge(G, (u, split_node_id, key1, edge1_data))
-        if split_node_id > v:
-            _reverse_edge(G, (v, split_node_id, key2, edge2_data))
+    return new_nodes
 
 
-def split_through_edges_in_intersections(G, intersections_gdf):
+def _find_split_points(G, intersections_gdf):
     """
-    Within each intersection polygon, split edges that are passing through it without having a node there.
-    This is helpful for a proper simplification of complex intersections
+    Find the edges passing through intersection polygons without having a node there,
+    together with the points where they should be split
 
     Parameters
     ----------
@@ -437,58 +539,90 @@ def split_through_edges_in_intersections(G, intersections_gdf):
 
     Returns
     -------
-    None
+    dict
+        (u, v, key) -> list of split points
     """
 
-    intersections_gdf = intersections_gdf.copy()
-    intersections_gdf['ix_geometry'] = intersections_gdf['geometry']
-    intersections_gdf['ix_centroid'] = intersections_gdf.centroid
-
     edges = oxc.graph_to_gdfs(G, nodes=False)
-    edges['e_geometry'] = edges['geometry']
-    #edges['u'] = edges.index.get_level_values('u')
-    #edges['v'] = edges.index.get_level_values('v')
-    #edges['key'] = edges.index.get_level_values('key')
-
-    # create new column with endpoints of each edge,
-    # we will need them to detect if an edge start/ends in an intersection buffer
-    edges['e_endpoints'] = edges.apply(
-        lambda x: shapely.ops.MultiPoint([
-            x['geometry'].coords[0],
-            x['geometry'].coords[-1]
-        ])
-        if isinstance(x.get('geometry'), shapely.ops.LineString) and not x.get('geometry').is_empty
-        else None,
-        axis=1
-    )
+    if len(edges) == 0 or len(intersections_gdf) == 0:
+        return {}
+
+    # work on plain geometry arrays, only simple linestrings can be split
+    e_geometries = edges.geometry.to_numpy()
+    e_valid = (shapely.get_type_id(e_geometries) == 1) & ~shapely.is_empty(e_geometries)
+    e_idx = np.flatnonzero(e_valid)
+    ix_geometries = intersections_gdf.geometry.to_numpy()
 
-    # build pairs of intersections and intersecting edges, keep index from edges
-    a = gpd.sjoin(edges, intersections_gdf, how="inner", predicate="intersects", lsuffix='e', rsuffix='i')
+    # build pairs of intersections and intersecting edges
+    pairs_e, pairs_ix = intersections_gdf.sindex.query(e_geometries[e_idx], predicate='intersects')
     # stop here if there are no edge/intersection pairs
-    if len(a) == 0:
-        return
-    # add a new column telling us whether the edge starts/ends within the intersection
-    a['edge_endpoint_in_intersection'] = a.apply(
-        lambda x: x['ix_geometry'].intersects(x['e_endpoints']),
-        axis=1
+    if len(pairs_e) == 0:
+        return {}
+    pairs_e = e_idx[pairs_e]
+    e_geometries = e_geometries[pairs_e]
+    ix_geometries = ix_geometries[pairs_ix]
+
+    # keep only those intersection/edge pairs where the edge does not start/end in the intersection
+    endpoint_in_intersection = (
+        shapely.intersects(ix_geometries, shapely.get_point(e_geometries, 0))
+        | shapely.intersects(ix_geometries, shapely.get_point(e_geometries, -1))
     )
-    # filter for only those intersection/edge pairs where the edge does not start/end in the intersection
-    a = a[a['edge_endpoint_in_intersection'] == False]
+    pairs_e = pairs_e[~endpoint_in_intersection]
+    e_geometries = e_geometries[~endpoint_in_intersection]
+    ix_geometries = ix_geometries[~endpoint_in_intersection]
 
     # stop here if there are no instances to process
-    if len(a) == 0:
-        return
+    if len(pairs_e) == 0:
+        return {}
 
-    # find out where should the edge be split
-    a['split_point'] = a.apply(
-        lambda x: shapely.ops.nearest_points(x['ix_centroid'], x['e_geometry'])[1],
-        axis=1
+    # find out where should the edge be split: the point on the edge closest to the intersection centroid
+    points = shapely.line_interpolate_point(
+        e_geometries,
+        shapely.line_locate_point(e_geometries, shapely.centroid(ix_geometries))
     )
 
-    a.apply(
-        lambda row: _split_edge(G, *row.name, row.split_point),
-        axis=1
-    )
+    # group the split points by edge, so that each edge can be split in one operation
+    split_points = {}
+    uvks = edges.index[pairs_e]
+    for uvk, point in zip(uvks, points):
+        split_points.setdefault(uvk, []).append(point)
+
+    return split_points
+
+
+def split_through_edges_in_intersections(G, intersections_gdf, max_iterations=10):
+    """
+    Within each intersection polygon, split edges that are passing through it without having a node there.
+    This is helpful for a proper simplification of complex intersections
+
+    The splitting is repeated until no more edges need to be split, or until max_iterations is reached.
+
+    Parameters
+    ----------
+    G : nx.MultiDiGraph or nx.MultiGraph
+        street graph
+    intersections_gdf : gpd.GeoDataFrame
+        intersection geometries
+    max_iterations : int
+        upper limit for the number of splitting passes
+
+    Returns
+    -------
+    new_nodes : list
+        ids of the nodes that have been created by splitting the edges
+    """
+
+    new_nodes = []
+    for i in range(max_iterations):
+        split_points = _find_split_points(G, intersections_gdf)
+        n_new_nodes = len(new_nodes)
+        for uvk, points in split_points.items():
+            new_nodes += _split_edge(G, *uvk, points)
+        # stop as soon as a fixed point is reached
+        if len(new_nodes) == n_new_nodes:
+            break
+
+    return new_nodes
 
 
 def _is_motorized(edge):
@@ -580,7 +714,67 @@ def _are_node_layers_compatible(layers1, layers2):
     return not set(nodes[0]).isdisjoint(set(nodes[1]))
 
 
-def connect_components_in_intersections(G, intersections_gdf, separate_layers=True):
+def _closest_pairs_between_components(node_ids, xy, components):
+    """
+    For every pair of components, find the closest pair of nodes, one from each component.
+    Works on plain arrays so that it can be run in a separate process.
+
+    Parameters
+    ----------
+    node_ids : list
+        node ids
+    xy : np.ndarray
+        node coordinates, shape (n, 2)
+    components : np.ndarray
+        component id of each node
+
+    Returns
+    -------
+    list
+        (node_a, node_b) tuples, one for each pair of components
+    """
+
+    component_labels = np.unique(components)
+    members = [np.flatnonzero(components == label) for label in component_labels]
+    trees = [cKDTree(xy[idx]) for idx in members]
+
+    pairs = []
+    for a, b in itertools.combinations(range(len(component_labels)), 2):
+        # query the smaller component against the tree of the larger one
+        if len(members[a]) > len(members[b]):
+            distances, positions = trees[a].query(xy[members[b]], k=1)
+            i = np.argmin(distances)
+            node_a = node_ids[members[a][positions[i]]]
+            node_b = node_ids[members[b][i]]
+        else:
+            distances, positions = trees[b].query(xy[members[a]], k=1)
+            i = np.argmin(distances)
+            node_a = node_ids[members[a][i]]
+            node_b = node_ids[members[b][positions[i]]]
+        pairs.append((node_a, node_b))
+
+    return pairs
+
+
+def _closest_pairs_between_components_of_clusters(clusters):
+    """
+    Apply _closest_pairs_between_components to a list of clusters (for multiprocessing)
+
+    Parameters
+    ----------
+    clusters : list
+        (node_ids, xy, components) tuples
+
+    Returns
+    -------
+    list
+        (node_a, node_b) tuples
+    """
+
+    return [pair for cluster in clusters for pair in _closest_pairs_between_components(*cluster)]
+
+
+def connect_components_in_intersections(G, intersections_gdf, separate_layers=True, cpus=1):
     """
     Creates connections between weakly connected components so that they can be merged into a single intersection
     In this process, we use the following restrictions:
@@ -595,12 +789,18 @@ def connect_components_in_intersections(G, intersections_gdf, separate_layers=Tr
         intersection geometries
     separate_layers : bool
         avoid connecting components that are on different layers (e.g., intersections above each other)
+    cpus : int
+        how many CPU cores to use for finding the closest node pairs; if None, use all available
 
     Returns
     -------
-    None
+    new_edges : list
+        (u, v, key) of the connecting edges that have been added
     """
 
+    if cKDTree is None:  # pragma: no cover
+        raise ImportError("scipy must be installed to connect components in intersections")
+
     # get the nodes as a geodataframe
     node_points = osmnx.graph_to_gdfs(G, edges=False)[["geometry", "street_count", "highway"]]
     # eliminate dead ends from the process to keep them as they are
@@ -610,56 +810,67 @@ def connect_components_in_intersections(G, intersections_gdf, separate_layers=Tr
     # clean up the columns of the resulting geodataframe (cluster=id of the intersection geometry)
     gdf = gdf.drop(columns="geometry").rename(columns={"index_right": "cluster"})
 
-    groups = gdf.groupby("cluster")
-    for cluster_label, nodes_subset in groups:
-        if len(nodes_subset) > 1:
-            # identify all (weakly connected) components in cluster
-            # wccs is a list of sets containing id's of the nodes in each weakly connected component
-            wccs = list(nx.weakly_connected_components(G.subgraph(nodes_subset.index)))
-            # skip this node if there are not at least two components (one component = no need for further connections)
-            if len(wccs) <= 1:
-                continue
-            nodes = []
-            layers = {}
-            # iterate over all combinations of the selected nodes (one from each wcc) to create a complete from-to mesh
-            for combination in itertools.combinations(range(len(wccs)),2):
-
-                a = combination[0]
-                b = combination[1]
-
-                # create gdfs of nodes from each wcc
-                a = oxc.graph_to_gdfs(G.subgraph(wccs[a]), edges=False)
-                b = oxc.graph_to_gdfs(G.subgraph(wccs[b]), edges=False)
-
-                # join with nearest points
-                joined = gpd.sjoin_nearest(a, b, distance_col="distance")
-                joined['node_a'] = joined.index
-                joined = joined.rename(columns={"index_right": "node_b"})
-
-                # get the closest pair
-                closest_pair = joined.sort_values(by='distance', ascending=True).to_dict('records')[0]
-                a = closest_pair['node_a']
-                b = closest_pair['node_b']
-
-                a_data = G.nodes[a]
-                b_data = G.nodes[b]
-
-                # skip this connector if the layer sets don't match
-                if (separate_layers
-                    and not _are_node_layers_compatible(a_data.get('layers'), b_data.get('layers'))
-                ):
-                    continue
-
-                geom = shapely.ops.LineString((
-                    shapely.ops.Point(a_data.get('x'), a_data.get('y')),
-                    shapely.ops.Point(b_data.get('x'), b_data.get('y'))
-                ))
-
-                G.add_edge(
-                    a, b, geometry=geom,
-                    osmid=0,
-                    _components_connector=True
-                )
+    # collect the nodes of each cluster as arrays, together with their (weakly connected) components
+    clusters = []
+    for cluster_label, nodes_subset in gdf.groupby("cluster"):
+        if len(nodes_subset) <= 1:
+            continue
+        # a list keeps the node ids as python values, numpy scalars would end up in the graph
+        node_ids = nodes_subset.index.tolist()
+        # components formed by the edges between the nodes of this cluster
+        incident_edges = G.edges(node_ids)
+        if G.is_directed():
+            incident_edges = itertools.chain(incident_edges, G.in_edges(node_ids))
+        labels = _union_find_labels(node_ids, incident_edges)
+        components = np.array([labels[node] for node in node_ids])
+        # skip this cluster if there are not at least two components (one component = no need for further connections)
+        if components.max() == 0:
+            continue
+        xy = np.array([(G.nodes[node]['x'], G.nodes[node]['y']) for node in node_ids], dtype=float)
+        clusters.append((node_ids, xy, components))
+
+    if cpus is None:
+        cpus = mp.cpu_count()
+    cpus = min(cpus, mp.cpu_count())
+
+    if cpus == 1 or len(clusters) < 2:
+        pairs = _closest_pairs_between_components_of_clusters(clusters)
+    else:
+        # divide clusters into equal-sized chunks for multiprocessing
+        size = int(np.ceil(len(clusters) / cpus))
+        args = ((clusters[i : i + size],) for i in range(0, len(clusters), size))
+        pool = mp.Pool(cpus)
+        sma = pool.starmap_async(_closest_pairs_between_components_of_clusters, args)
+        results = sma.get()
+        pool.close()
+        pool.join()
+        pairs = [pair for result in results for pair in result]
+
+    new_edges = []
+    for a, b in pairs:
+
+        a_data = G.nodes[a]
+        b_data = G.nodes[b]
+
+        # skip this connector if the layer sets don't match
+        if (separate_layers
+            and not _are_node_layers_compatible(a_data.get('layers'), b_data.get('layers'))
+        ):
+            continue
+
+        geom = shapely.ops.LineString((
+            shapely.ops.Point(a_data.get('x'), a_data.get('y')),
+            shapely.ops.Point(b_data.get('x'), b_data.get('y'))
+        ))
+
+        key = G.add_edge(
+            a, b, geometry=geom,
+            osmid=0,
+            _components_connector=True
+        )
+        new_edges.append((a, b, key))
+
+    return new_edges
 
 
 def update_precalculated_attributes(G):
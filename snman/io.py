@@ -1,17 +1,218 @@
 from . import osmnx_customized as oxc
-from . import geometry_tools, lanes
+from . import geometry_tools, graph_tools, lanes
+from ._version import __version__
 import geopandas as gpd
 import pandas as pd
 import pyproj
-import shapely.ops
 import shapely.geometry
 import shapely
-import xml.etree.ElementTree as ET
-import itertools
+import xml.sax.saxutils
 import networkx as nx
-import copy
 import numpy as np
 import json
+import os
+import itertools
+import gzip
+import bz2
+import pickle
+import multiprocessing as mp
+import multiprocessing.pool
+import functools
+import inspect
+import hashlib
+import glob
+import tempfile
+import time
+
+# pyarrow is an optional dependency for graph snapshots
+try:
+    import pyarrow as pa
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:  # pragma: no cover
+    pa = None
+
+# pyogrio is an optional dependency for reading only the features within a perimeter
+try:
+    import pyogrio
+except ImportError:  # pragma: no cover
+    pyogrio = None
+
+# osmium is an optional dependency for the PBF export
+try:
+    import osmium
+except ImportError:  # pragma: no cover
+    osmium = None
+
+# folder in which processed input files are cached, see _cached_input (None -> no caching)
+cache_folder = None
+# maximum total size of the cached files in bytes, the least recently used ones are removed first
+cache_size_limit = 2 * 1024 ** 3
+# part of every cache key, increase it when the format of the cached results changes
+_CACHE_FORMAT = 1
+# temporary cache files older than this (in seconds) are left over from interrupted writes
+_CACHE_STALE_TEMPORARY_AGE = 24 * 3600
+
+
+def _cached_input(loader):
+    """
+    Decorator that caches the results of a function loading an input file in the cache_folder
+
+    The first argument of the function must be the path of the input file. A result is reused as long as the
+    function, the modification time and size of the file, the other arguments and the versions of snman and the
+    libraries producing the result are the same.
+    Calls with arguments that cannot be fingerprinted, e.g. graphs, are not cached.
+
+    Parameters
+    ----------
+    loader : function
+
+    Returns
+    -------
+    function
+    """
+
+    signature = inspect.signature(loader)
+
+    @functools.wraps(loader)
+    def cached_loader(*args, **kwargs):
+        if cache_folder is None:
+            return loader(*args, **kwargs)
+
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        path, *other_arguments = arguments.arguments.items()
+        try:
+            key = [
+                _CACHE_FORMAT, __version__, gpd.__version__, pd.__version__, shapely.__version__,
+                loader.__module__, loader.__qualname__, _file_fingerprint(path[1])
+            ]
+            key += [(name, _value_fingerprint(value)) for name, value in other_arguments]
+        except (TypeError, OSError):
+            return loader(*args, **kwargs)
+        cache_path = os.path.join(cache_folder, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+        try:
+            with open(cache_path, 'rb') as file:
+                result = pickle.load(file)
+            # mark the file as recently used
+            os.utime(cache_path)
+            return result
+        except Exception:
+            # missing, removed in the meantime or unreadable (e.g. written by an incompatible version) -> recompute
+            pass
+
+        result = loader(*args, **kwargs)
+
+        # write to a temporary file of this process first, so that other processes never read a partial file
+        os.makedirs(cache_folder, exist_ok=True)
+        handle, temporary_path = tempfile.mkstemp(dir=cache_folder, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_path, cache_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        _evict_cache()
+
+        return result
+
+    return cached_loader
+
+
+def _file_fingerprint(path):
+    """
+    Identify the state of a file by its path, modification time and size.
+    For shapefiles, the sidecar files (.dbf, .prj, etc.) are included.
+
+    Parameters
+    ----------
+    path : str
+
+    Returns
+    -------
+    list
+        (path, modification time, size) of each file
+    """
+
+    path = os.path.abspath(path)
+    base, extension = os.path.splitext(path)
+    paths = {path}
+    if extension.lower() == '.shp':
+        paths.update(glob.glob(glob.escape(base) + '.*'))
+
+    fingerprint = []
+    for path in sorted(paths):
+        stat = os.stat(path)
+        fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+    return fingerprint
+
+
+def _value_fingerprint(value):
+    """
+    Convert an argument into a value with a stable repr, to be used in a cache key
+
+    Parameters
+    ----------
+    value : None, bool, int, float, str, list, tuple, set, dict, DataFrame, Series or shapely geometry
+
+    Returns
+    -------
+    fingerprint
+    """
+
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    elif isinstance(value, (list, tuple)):
+        return type(value).__name__, [_value_fingerprint(item) for item in value]
+    elif isinstance(value, (set, frozenset)):
+        return type(value).__name__, sorted(repr(_value_fingerprint(item)) for item in value)
+    elif isinstance(value, dict):
+        return 'dict', sorted((repr(k), repr(_value_fingerprint(v))) for k, v in value.items())
+    elif isinstance(value, (pd.DataFrame, pd.Series, shapely.geometry.base.BaseGeometry)):
+        return type(value).__name__, hashlib.sha1(pickle.dumps(value)).hexdigest()
+    else:
+        raise TypeError(f"Cannot fingerprint {type(value)}")
+
+
+def _evict_cache():
+    """
+    Remove the least recently used files from the cache_folder until it fits into the cache_size_limit.
+    The most recently used file is always kept. Temporary files left over from interrupted writes are removed
+    once they are older than _CACHE_STALE_TEMPORARY_AGE.
+
+    Returns
+    -------
+    None
+    """
+
+    now = time.time()
+    stats = []
+    for file_name in os.listdir(cache_folder):
+        path = os.path.join(cache_folder, file_name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # removed by another process in the meantime
+            continue
+        if path.endswith('.pkl'):
+            stats.append((stat, path))
+        elif path.endswith('.tmp') and now - stat.st_mtime > _CACHE_STALE_TEMPORARY_AGE:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    stats.sort(key=lambda stat: stat[0].st_mtime_ns, reverse=True)
+
+    total_size = 0
+    for i, (stat, path) in enumerate(stats):
+        total_size += stat.st_size
+        if total_size > cache_size_limit and i > 0:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
 
 def load_street_graph(edges_path, nodes_path, crs=2056):
@@ -39,16 +240,99 @@ def load_street_graph(edges_path, nodes_path, crs=2056):
     _iterable_columns_from_strings(edges_gdf, {'sensors_forward', 'sensors_backward'}, method='str')
     _iterable_columns_from_strings(nodes_gdf, {'layers'}, method='str')
 
+    # convert the rows into plain dicts once and add them in bulk
     G = nx.MultiGraph(crs=crs)
-    nodes_gdf.apply(lambda n: G.add_node(n.name, **n), axis=1)
-    edges_gdf.apply(lambda e: G.add_edge(*e.name, **e), axis=1)
+    G.add_nodes_from(zip(nodes_gdf.index, _records(nodes_gdf)))
+    G.add_edges_from((u, v, key, data) for (u, v, key), data in zip(edges_gdf.index, _records(edges_gdf)))
+
+    return G
+
+
+def load_snapshot(path, nodes=None, memory_map=False):
+    """
+    Load a street graph from a snapshot created by save_snapshot()
+
+    Parameters
+    ----------
+    path : str
+        directory containing the snapshot
+    nodes : iterable
+        if given, only load the subgraph induced by these nodes
+    memory_map : bool
+        memory-map the snapshot files instead of reading them, so that processes loading the same snapshot
+        share one copy in the page cache and only the rows of the requested nodes and edges are decoded
+
+    Returns
+    -------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph, with the same graph class, attributes and attribute types as the saved one
+    """
+
+    node_table, edge_table = open_snapshot(path, memory_map=memory_map)
+
+    metadata = node_table.schema.metadata
+    G = getattr(nx, metadata[b'graph_class'].decode())()
+    G.graph.update(pickle.loads(metadata[b'graph']))
+
+    if nodes is not None:
+        nodes = list(nodes)
+        node_table = node_table.filter(_snapshot_isin(node_table, '__id_0__', nodes))
+        edge_table = edge_table.filter(pa.compute.and_(
+            _snapshot_isin(edge_table, '__id_0__', nodes),
+            _snapshot_isin(edge_table, '__id_1__', nodes)
+        ))
+
+    node_ids, node_data = _decode_snapshot_table(node_table)
+    G.add_nodes_from(zip(node_ids, node_data))
+    edge_ids, edge_data = _decode_snapshot_table(edge_table)
+    G.add_edges_from((u, v, key, data) for (u, v, key), data in zip(edge_ids, edge_data))
 
     return G
 
 
-def import_geofile_to_gdf(file_path, crs=2056, index=None, filter_index=None, perimeter=None):
+def open_snapshot(path, memory_map=True):
+    """
+    Open the node and edge tables of a snapshot created by save_snapshot(), without building a graph
+
+    The columns can be used directly as arrays, e.g. node_table['x'].to_numpy().
+    Memory-mapping is zero-copy only if the snapshot was saved without compression.
+
+    Parameters
+    ----------
+    path : str
+        directory containing the snapshot
+    memory_map : bool
+        memory-map the files instead of reading them into memory
+
+    Returns
+    -------
+    node_table : pa.Table
+        one row per node, the node ids are in the column '__id_0__'
+    edge_table : pa.Table
+        one row per edge, u, v and key are in the columns '__id_0__', '__id_1__' and '__id_2__'
+    """
+
+    if pa is None:  # pragma: no cover
+        raise ImportError("pyarrow must be installed to load snapshots")
+
+    tables = []
+    for file_name in ['nodes.arrow', 'edges.arrow']:
+        file_path = os.path.join(path, file_name)
+        if memory_map:
+            # the table keeps referencing the memory-mapped file, so it must stay open
+            tables.append(pa.ipc.open_file(pa.memory_map(file_path, 'r')).read_all())
+        else:
+            with pa.OSFile(file_path, 'rb') as source:
+                tables.append(pa.ipc.open_file(source).read_all())
+
+    return tuple(tables)
+
+
+@_cached_input
+def import_geofile_to_gdf(file_path, crs=2056, index=None, filter_index=None, perimeter=None, columns=None):
     """
     Import a geofile (shp, gpkg, etc.) as a GeoDataFrame
+    If snman.io.cache_folder is set, the result is cached on disk until the file changes.
 
     Parameters
     ----------
@@ -59,8 +343,11 @@ def import_geofile_to_gdf(file_path, crs=2056, index=None, filter_index=None, pe
         which column(s) should be used as index
     filter_index : list
         which rows should be included, by index values
-    perimeter : polygon
-        will be used to crop the imported geometries
+    perimeter : gpd.GeoDataFrame
+        will be used to crop the imported geometries; if pyogrio is installed, only features within its bounding box
+        are read from the file (a perimeter without crs is assumed to be in the target crs)
+    columns : list
+        which columns should be read, besides the geometry and index (None -> read all columns)
 
     Returns
     -------
@@ -68,7 +355,35 @@ def import_geofile_to_gdf(file_path, crs=2056, index=None, filter_index=None, pe
         resulting GeoDataFrame
     """
 
-    gdf = gpd.read_file(file_path).to_crs(crs)
+    read_kwargs = {}
+
+    if columns is not None:
+        index_columns = [] if index is None else [index] if isinstance(index, str) else list(index)
+        columns = list(dict.fromkeys(index_columns + list(columns)))
+
+    # a perimeter without crs is assumed to be in the target crs
+    if perimeter is not None and perimeter.crs is None:
+        perimeter = perimeter.set_crs(crs)
+
+    if pyogrio is None:
+        # without pyogrio, the whole file is read and cropped afterwards
+        gdf = gpd.read_file(file_path)
+        if columns is not None:
+            gdf = gdf[columns + [gdf.geometry.name]]
+    else:
+        if columns is not None:
+            read_kwargs['columns'] = columns
+        # only read the features in the bounding box of the perimeter, in the crs of the file
+        # (a file without crs is assumed to be in the crs of the perimeter)
+        if perimeter is not None:
+            file_crs = pyogrio.read_info(file_path)['crs']
+            if file_crs is not None:
+                read_kwargs['bbox'] = tuple(perimeter.to_crs(file_crs).total_bounds)
+            else:
+                read_kwargs['bbox'] = tuple(perimeter.total_bounds)
+        gdf = gpd.read_file(file_path, engine='pyogrio', **read_kwargs)
+
+    gdf = gdf.to_crs(crs)
     if index is not None:
         gdf = gdf.set_index(index)
 
@@ -215,12 +530,13 @@ def load_measurement_regions(path):
     return measurement_regions
 
 
-def load_poi(path, perimeter=None):
+def load_poi(path, perimeter=None, columns=None):
 
-    poi = import_geofile_to_gdf(path, perimeter=perimeter)
+    poi = import_geofile_to_gdf(path, perimeter=perimeter, columns=columns)
     return poi
 
 
+@_cached_input
 def load_sensors(path):
 
     sensors = pd.read_csv(path).set_index('id')
@@ -248,7 +564,9 @@ def _get_nodes_within_polygon(G, polygon):
     return set(nodes_gdf.index.values)
 
 
-def export_street_graph(G, path_edges, path_nodes, edge_columns=None, node_columns=None):
+def export_street_graph(
+        G, path_edges, path_nodes, edge_columns=None, node_columns=None, engine=None, parallel=False
+):
     """
     Export street graph as a geofile (shp, gpkg, etc.)
 
@@ -264,6 +582,11 @@ def export_street_graph(G, path_edges, path_nodes, edge_columns=None, node_colum
         which columns should be included in the edges file (None -> include all columns)
     node_columns : list
         dito for nodes file
+    engine : str
+        which library geopandas should use for writing: 'pyogrio' (vectorised) or 'fiona'
+        (None -> 'pyogrio' if it is installed, otherwise the geopandas default)
+    parallel : bool
+        write the nodes and edges files at the same time, in two threads
 
     Returns
     -------
@@ -276,23 +599,79 @@ def export_street_graph(G, path_edges, path_nodes, edge_columns=None, node_colum
         edges = edges[list(set(set(edges.columns) & set(edge_columns)).union({'geometry'}))]
 
     if node_columns:
-        nodes = edges[list(set(set(nodes.columns) & set(node_columns)).union({'geometry'}))]
-
-    # Limit every attribute to 10 characters to match the SHP format restrictions
-    if path_edges.split()[-1] == 'shp':
-        edges.columns = [column[0:10] for column in edges.columns]
+        nodes = nodes[list(set(set(nodes.columns) & set(node_columns)).union({'geometry'}))]
 
     # stringify iterable columns
     _stringify_iterable_columns(edges, {'ln_desc', 'ln_desc_after', 'given_lanes'}, separator=' | ')
     _stringify_iterable_columns(edges, {'sensors_forward', 'sensors_backward'}, method='str')
     _stringify_iterable_columns(nodes, {'layers'}, method='str')
 
+    # Limit every attribute to 10 characters to match the SHP format restrictions
+    if path_edges.split('.')[-1] == 'shp':
+        edges.columns = [column[0:10] for column in edges.columns]
+
+    if engine is None and pyogrio is not None:
+        engine = 'pyogrio'
+
     # write files
-    export_gdf(edges, path_edges)
-    export_gdf(nodes, path_nodes)
+    args = [(edges, path_edges, [], engine), (nodes, path_nodes, [], engine)]
+    if parallel:
+        pool = mp.pool.ThreadPool(2)
+        pool.starmap(export_gdf, args)
+        pool.close()
+        pool.join()
+    else:
+        for arg in args:
+            export_gdf(*arg)
 
 
-def export_street_graph_with_lanes(G, lanes_attribute, path, scaling=1):
+def save_snapshot(G, path, compression=None):
+    """
+    Save a street graph as a lossless binary snapshot, to be loaded again with load_snapshot()
+
+    The snapshot is a directory with the nodes and edges as Arrow IPC files, one column per attribute.
+    Attributes holding numbers, strings or lists of them are stored as native Arrow arrays,
+    geometries as WKB, and attributes with mixed or other types are pickled cell by cell.
+    Numpy scalars are stored as the corresponding python values.
+
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    path : str
+        directory where the snapshot should be saved, will be created if necessary
+    compression : str
+        compression of the Arrow buffers: None, 'lz4' or 'zstd'
+
+    Returns
+    -------
+    None
+    """
+
+    if pa is None:  # pragma: no cover
+        raise ImportError("pyarrow must be installed to save snapshots")
+
+    os.makedirs(path, exist_ok=True)
+
+    node_ids, node_data = zip(*G.nodes(data=True)) if len(G) else ((), ())
+    nodes = _encode_snapshot_table([node_ids], node_data)
+    nodes = nodes.replace_schema_metadata({
+        'graph_class': type(G).__name__,
+        'graph': pickle.dumps(G.graph),
+    })
+
+    edges = list(G.edges(keys=True, data=True))
+    edge_ids = [[edge[i] for edge in edges] for i in range(3)]
+    edges = _encode_snapshot_table(edge_ids, [edge[3] for edge in edges])
+
+    options = pa.ipc.IpcWriteOptions(compression=compression)
+    for table, file_name in [(nodes, 'nodes.arrow'), (edges, 'edges.arrow')]:
+        with pa.OSFile(os.path.join(path, file_name), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema, options=options) as writer:
+                writer.write_table(table)
+
+
+def export_street_graph_with_lanes(G, lanes_attribute, path, scaling=1, cpus=1, chunk_size=None):
     """
     Export a geofile with individual lane geometries. This is helpful for visualization purposes.
 
@@ -306,58 +685,143 @@ def export_street_graph_with_lanes(G, lanes_attribute, path, scaling=1):
         where should the file be saved
     scaling : float
         optional scaling of the lane width, for an optimized visualization
+    cpus : int
+        how many CPU cores to use for offsetting the lane geometries; if None, use all available
+    chunk_size : int
+        if given, the lanes are generated, offset and appended to the file in chunks of this size,
+        so that only the lanes of one chunk per CPU core are held in memory at the same time
 
     Returns
     -------
     None
     """
 
-    # Create empty list for the lanes
-    lanes_list = []
+    if cpus is None:
+        cpus = mp.cpu_count()
+    cpus = min(cpus, mp.cpu_count())
+
+    chunks = _lane_chunks(G, lanes_attribute, scaling, chunk_size)
+    pool = None
+    chunk_id = 0
+
+    # Offset the geometries of as many chunks at once as there are CPU cores, and write them once they are ready
+    while True:
+        batch = list(itertools.islice(chunks, cpus))
+        if len(batch) == 0:
+            break
+        args = [(columns['geometry'], distances) for columns, distances in batch]
+        if len(batch) == 1:
+            results = map(_offset_lane_geometries, args)
+        else:
+            if pool is None:
+                pool = mp.Pool(cpus)
+            results = pool.imap(_offset_lane_geometries, args)
+
+        for (columns, distances), chunk_geometries in zip(batch, results):
+            columns['geometry'] = chunk_geometries
+            lanes_gdf = gpd.GeoDataFrame(
+                columns,
+                columns=['type', 'direction', 'descr', 'width_m', 'layer', 'geometry'],
+                geometry='geometry'
+            )
+            lanes_gdf.to_file(path, mode='w' if chunk_id == 0 else 'a')
+            chunk_id += 1
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _lane_chunks(G, lanes_attribute, scaling=1, chunk_size=None):
+    """
+    Generate the lanes of a street graph in chunks, together with the offset of each lane from its edge centerline
 
-    for id, data in G.edges.items():
-        given_total_width = 0
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    lanes_attribute : str
+        which attribute should be used as a source of the lane configuration of each edge
+    scaling : float
+        optional scaling of the lane width
+    chunk_size : int
+        maximum number of lanes per chunk (None -> all lanes in one chunk)
+
+    Returns
+    -------
+    generator
+        (columns, distances) of each chunk, at least one chunk even if there are no lanes;
+        columns is a dict of lists with the lane attributes and the geometries of the edges (not offset yet),
+        distances is an array with the offset of each lane
+    """
+
+    # Properties of each distinct lane description, computed only once
+    lane_properties = {}
+
+    def empty_chunk():
+        return {'type': [], 'direction': [], 'descr': [], 'width_m': [], 'layer': [], 'geometry': []}, []
+
+    columns, distances = empty_chunk()
+    n_chunks = 0
+
+    for data in G.edges.values():
+        edge_lanes = data.get(lanes_attribute, [])
+        for lane in edge_lanes:
+            if lane not in lane_properties:
+                lane_properties[lane] = lanes._lane_properties(lane)
 
         # Reconstruct total width of given lanes
-        for lane in data.get(lanes_attribute, []):
-            lane_properties = lanes._lane_properties(lane)
-            given_total_width += lane_properties.width
+        given_total_width = sum(lane_properties[lane].width for lane in edge_lanes)
 
         offset = -given_total_width / 2
-        for lane in data.get(lanes_attribute, []):
-            lane_properties = lanes._lane_properties(lane)
-
-            centerline_offset = offset + lane_properties.width / 2
-            offset += lane_properties.width
-            geom = data.get('geometry')
-
-            if geom and round(centerline_offset, 1) != 0:
-                geom = geom.parallel_offset(centerline_offset * scaling, 'right')
-                # the above function reverses direction when the offset is positive, this steps reverses it back
-                if centerline_offset > 0 and not geom.is_empty:
-                    # geom.coords = list(geom.coords)[::-1]
-                    shapely.ops.substring(geom, 1, 0, normalized=True)
-                    pass
-
-            lanes_list.append({
-                'type': lane_properties.lanetype,
-                'direction': lane_properties.direction,
-                'descr': lane,
-                'width_m': lane_properties.width * scaling,
-                'layer': data.get('layer'),
-                'geometry': geom
-            })
-
-    lanes_gdf = gpd.GeoDataFrame(
-        lanes_list,
-        columns=['type', 'direction', 'descr', 'width_m', 'layer', 'geometry'],
-        geometry='geometry'
-    )
+        for lane in edge_lanes:
+            properties = lane_properties[lane]
+
+            centerline_offset = offset + properties.width / 2
+            offset += properties.width
+
+            columns['type'].append(properties.lanetype)
+            columns['direction'].append(properties.direction)
+            columns['descr'].append(lane)
+            columns['width_m'].append(properties.width * scaling)
+            columns['layer'].append(data.get('layer'))
+            columns['geometry'].append(data.get('geometry'))
+            distances.append(centerline_offset * scaling if round(centerline_offset, 1) != 0 else 0)
+
+            if chunk_size is not None and len(distances) >= chunk_size:
+                columns['geometry'] = np.array(columns['geometry'], dtype=object)
+                yield columns, np.array(distances, dtype=float)
+                n_chunks += 1
+                columns, distances = empty_chunk()
+
+    if len(distances) > 0 or n_chunks == 0:
+        columns['geometry'] = np.array(columns['geometry'], dtype=object)
+        yield columns, np.array(distances, dtype=float)
+
+
+def _offset_lane_geometries(chunk):
+    """
+    Offset lane geometries to the right (for multiprocessing)
+
+    Parameters
+    ----------
+    chunk : tuple
+        array of geometries and array of offset distances, geometries with a distance of 0 are kept as they are
+
+    Returns
+    -------
+    geometries : np.ndarray
+    """
 
-    export_gdf(lanes_gdf, path)
+    geometries, distances = chunk
+    geometries = geometries.copy()
+    to_offset = (distances != 0) & ~shapely.is_missing(geometries) & ~shapely.is_empty(geometries)
+    # keep the direction of the geometries, like the right-hand parallel_offset of shapely 2
+    geometries[to_offset] = shapely.offset_curve(geometries[to_offset], -distances[to_offset], quad_segs=16)
+    return geometries
 
 
-def export_gdf(gdf, path, columns=[]):
+def export_gdf(gdf, path, columns=[], engine=None):
     """
     Export a GeoDataFrame into a geofile.
     A wrapper around GeoDataFrame.to_file() but with an optional column filter.
@@ -368,6 +832,8 @@ def export_gdf(gdf, path, columns=[]):
     path : str
     columns : list
         which columns should be included ([] -> include all columns)
+    engine : str
+        which library geopandas should use for writing: 'pyogrio' or 'fiona' (None -> geopandas default)
 
     Returns
     -------
@@ -375,9 +841,9 @@ def export_gdf(gdf, path, columns=[]):
     """
 
     if columns == []:
-        gdf.to_file(path)
+        gdf.to_file(path, engine=engine)
     else:
-        gdf[columns].to_file(path)
+        gdf[columns].to_file(path, engine=engine)
 
 
 def convert_crs_of_street_graph(G, to_crs):
@@ -408,23 +874,42 @@ def convert_crs_of_street_graph(G, to_crs):
     # Update the street_graph's metadata
     G.graph["crs"] = to_crs
 
-    # Transform the geometry of all edges
-    for edge in G.edges(data=True, keys=True):
-        if "geometry" in edge[3]:
-            edge[3]["geometry"] = shapely.ops.transform(project, edge[3]["geometry"])
+    # Gather the coordinates of all nodes and edge geometries, geometries with z coordinates are kept apart
+    # so that the other geometries remain two-dimensional
+    node_data = list(G.nodes.values())
+    edge_data = [data for u, v, k, data in G.edges(keys=True, data=True) if "geometry" in data]
+    geometries = np.array([data["geometry"] for data in edge_data], dtype=object)
+    has_z = shapely.has_z(geometries)
+    coords = shapely.get_coordinates(geometries[~has_z])
+
+    # Transform them all at once
+    n_nodes = len(node_data)
+    x = np.concatenate([[data.get('x') for data in node_data], coords[:, 0]]).astype(float)
+    y = np.concatenate([[data.get('y') for data in node_data], coords[:, 1]]).astype(float)
+    x, y = project(x, y)
+    geometries[~has_z] = shapely.set_coordinates(geometries[~has_z], np.column_stack([x[n_nodes:], y[n_nodes:]]))
+    if has_z.any():
+        coords_z = shapely.get_coordinates(geometries[has_z], include_z=True)
+        geometries[has_z] = shapely.set_coordinates(
+            geometries[has_z], np.column_stack(project(coords_z[:, 0], coords_z[:, 1], coords_z[:, 2]))
+        )
+
+    # Write back the geometry of all edges
+    for data, geometry in zip(edge_data, geometries):
+        data["geometry"] = geometry
 
-    # Transform the geometry of all nodes
-    for id, data in G.nodes.items():
-        geom = shapely.geometry.Point(data.get('x'), data.get('y'))
-        geom = shapely.ops.transform(project, geom)
-        data['x'] = geom.x
-        data['y'] = geom.y
+    # Write back the geometry of all nodes
+    for data, node_x, node_y in zip(node_data, x[:n_nodes].tolist(), y[:n_nodes].tolist()):
+        data['x'] = node_x
+        data['y'] = node_y
 
 
-def export_osm_xml(G, path, tags, uv_tags=False, tag_all_nodes=False):
+def export_osm_xml(G, path, tags, uv_tags=False, tag_all_nodes=False, compression='infer'):
     """
     Generates an OSM file from the street graph
 
+    The file is written incrementally and the coordinates are reprojected in bulk, without copying the graph.
+
     Parameters
     ----------
     G : nx.MultiGraph or nx.MultiDiGraph
@@ -436,107 +921,444 @@ def export_osm_xml(G, path, tags, uv_tags=False, tag_all_nodes=False):
         include special tags for the start and end node of each edge (for debugging)
     tag_all_nodes : bool
         add a special tag to each node so that all nodes appear as points when imported in QGIS (for debugging)
+    compression : str
+        None, 'gzip' or 'bz2', or 'infer' to choose it from the file extension (.gz or .bz2)
 
     Returns
     -------
     None
     """
 
-    # initial ID value for new OSM objects, avoid duplicity with graph node ids
-    max_node_id = max(list(G.nodes))
-    osm_id = itertools.count(max_node_id * 100)
+    bounds, nodes, ways = _osm_elements(G, tags, uv_tags)
 
-    # make a copy of the original graph and convert it to pseudo mercator which is the official OSM crs
-    G = copy.deepcopy(G)
-    convert_crs_of_street_graph(G, 'epsg:4326')
+    with _open_text_file(path, compression) as file:
+        lines = []
 
-    # here, we build the XML tree...
-    # create the overall structure of the XML
-    tree = ET.ElementTree('tree')
+        def write(line, flush=False):
+            lines.append(line)
+            if flush or len(lines) >= 10000:
+                file.writelines(lines)
+                lines.clear()
 
-    # add OSM metadata
-    osm = ET.Element('osm', attrib={
-        'version': '0.6',
-        'generator': 'osmium/1.14.0'
-    })
+        write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        write('<osm version="0.6" generator="osmium/1.14.0">\n')
+        min_lon, min_lat, max_lon, max_lat = bounds
+        write(f'  <bounds minlat="{min_lat}" minlon="{min_lon}" maxlat="{max_lat}" maxlon="{max_lon}" />\n')
 
-    # bounds
-    lats = [data.get('y') for id, data in G.nodes.items()]
-    lons = [data.get('x') for id, data in G.nodes.items()]
-    ET.SubElement(osm, 'bounds', attrib={
-        'minlat': str(min(lats)),
-        'minlon': str(min(lons)),
-        'maxlat': str(max(lats)),
-        'maxlon': str(max(lons))
-    })
+        for node_id, lat, lon in nodes:
+            node = f'  <node id="{node_id}" version="1" timestamp="2000-01-01T00:00:00Z" lat="{lat}" lon="{lon}"'
+            if tag_all_nodes:
+                write(node + '>\n    <tag k="_node" v="true" />\n  </node>\n')
+            else:
+                write(node + ' />\n')
+
+        for way_id, refs, way_tags in ways:
+            way = [f'  <way id="{way_id}" version="1" timestamp="2000-01-01T00:00:00Z">\n']
+            way.extend(f'    <nd ref="{ref}" />\n' for ref in refs)
+            way.extend(f'    <tag k={_xml_attribute(k)} v={_xml_attribute(v)} />\n' for k, v in way_tags)
+            way.append('  </way>\n')
+            write(''.join(way))
+
+        write('</osm>', flush=True)
+
+
+def export_osm_pbf(G, path, tags, uv_tags=False, tag_all_nodes=False, compression='zlib'):
+    """
+    Generates an OSM PBF file from the street graph, with the same content as export_osm_xml()
+
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    path : str
+    tags : list
+        which OSM tags should be included
+    uv_tags : bool
+        include special tags for the start and end node of each edge (for debugging)
+    tag_all_nodes : bool
+        add a special tag to each node so that all nodes appear as points when imported in QGIS (for debugging)
+    compression : str
+        compression of the PBF blocks: 'zlib', 'lz4' or 'none'
+
+    Returns
+    -------
+    None
+    """
+
+    if osmium is None:  # pragma: no cover
+        raise ImportError("osmium must be installed to export PBF files")
+
+    bounds, nodes, ways = _osm_elements(G, tags, uv_tags)
+
+    header = osmium.io.Header()
+    header.set('generator', 'snman')
+    header.add_box(osmium.osm.Box(
+        osmium.osm.Location(bounds[0], bounds[1]), osmium.osm.Location(bounds[2], bounds[3])
+    ))
+
+    timestamp = '2000-01-01T00:00:00Z'
+    node_tags = {'_node': 'true'} if tag_all_nodes else {}
+    writer = osmium.SimpleWriter(
+        osmium.io.File(path, f'pbf,pbf_compression={compression}'), header=header, overwrite=True
+    )
+    try:
+        for node_id, lat, lon in nodes:
+            writer.add_node(osmium.osm.mutable.Node(
+                id=node_id, version=1, timestamp=timestamp, location=(lon, lat), tags=node_tags
+            ))
+        for way_id, refs, way_tags in ways:
+            writer.add_way(osmium.osm.mutable.Way(
+                id=way_id, version=1, timestamp=timestamp, nodes=refs, tags=way_tags
+            ))
+    finally:
+        writer.close()
+
+
+def _osm_elements(G, tags, uv_tags=False):
+    """
+    Prepare the OSM nodes and ways of a street graph, reprojected to WGS84, without copying the graph
+
+    Each edge becomes a way from its start to its end node, with a new node for each intermediary point
+    of its geometry.
+
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    tags : list
+        which OSM tags should be included
+    uv_tags : bool
+        include special tags for the start and end node of each edge (for debugging)
+
+    Returns
+    -------
+    bounds : tuple
+        (min_lon, min_lat, max_lon, max_lat) of all graph nodes
+    nodes : generator
+        (id, lat, lon) of each node used by the ways
+    ways : generator
+        (id, node ids, list of (key, value) tags) of each way
+    """
+
+    # WGS84 is the official OSM crs
+    project = pyproj.Transformer.from_crs(
+        pyproj.CRS(G.graph['crs']), pyproj.CRS('epsg:4326'), always_xy=True
+    ).transform
+
+    # coordinates of the graph nodes
+    node_ids = list(G.nodes)
+    node_lon, node_lat = project(
+        np.array([data.get('x') for data in G.nodes.values()], dtype=float),
+        np.array([data.get('y') for data in G.nodes.values()], dtype=float)
+    )
+    node_lon, node_lat = node_lon.tolist(), node_lat.tolist()
+    bounds = (min(node_lon), min(node_lat), max(node_lon), max(node_lat))
+
+    # coordinates of the intermediary points of all edge geometries, excluding the first and last one,
+    # which are replaced by the graph nodes
+    edges = list(G.edges(keys=True, data=True))
+    geometries = np.array([data.get('geometry') for u, v, key, data in edges], dtype=object)
+    coords, index = shapely.get_coordinates(geometries, return_index=True)
+    edge_bounds = np.searchsorted(index, np.arange(len(edges) + 1))
+    n_points = np.diff(edge_bounds)
+    is_intermediary = np.ones(len(coords), dtype=bool)
+    is_intermediary[edge_bounds[:-1][n_points > 0]] = False
+    is_intermediary[edge_bounds[1:][n_points > 0] - 1] = False
+    point_lon, point_lat = project(coords[is_intermediary, 0], coords[is_intermediary, 1])
+    point_lon, point_lat = point_lon.tolist(), point_lat.tolist()
+
+    # IDs for new OSM objects, avoid duplicity with graph node ids
+    # each way gets a new id, followed by the ids of its intermediary nodes
+    n_intermediary = np.maximum(n_points - 2, 0)
+    new_ids = list(itertools.islice(graph_tools._unused_node_ids(G), len(edges) + len(point_lon)))
+    is_way = np.zeros(len(new_ids), dtype=bool)
+    is_way[np.arange(len(edges)) + np.cumsum(n_intermediary) - n_intermediary] = True
+    way_ids = [new_id for new_id, way in zip(new_ids, is_way) if way]
+    point_ids = [new_id for new_id, way in zip(new_ids, is_way) if not way]
+
+    # the graph nodes used by the ways and the intermediary nodes
+    used_nodes = {u for u, v, key, data in edges} | {v for u, v, key, data in edges}
+    nodes = itertools.chain(
+        (
+            (node_id, lat, lon)
+            for node_id, lat, lon in zip(node_ids, node_lat, node_lon)
+            if node_id in used_nodes
+        ),
+        zip(point_ids, point_lat, point_lon)
+    )
+
+    def generate_ways():
+        remaining_point_ids = iter(point_ids)
+        for (u, v, key, data), way_id, n in zip(edges, way_ids, n_intermediary.tolist()):
+            refs = [u, *itertools.islice(remaining_point_ids, n), v]
+            # skip the tags that are not defined for this way
+            way_tags = [(tag, str(data.get(tag))) for tag in tags if data.get(tag, None) is not None]
+            if uv_tags:
+                way_tags += [('_u', str(u)), ('_v', str(v)), ('_key', str(key))]
+            yield way_id, refs, way_tags
+
+    return bounds, nodes, generate_ways()
+
+
+def _open_text_file(path, compression='infer'):
+    """
+    Open a text file for writing, optionally compressed
+
+    Parameters
+    ----------
+    path : str
+    compression : str
+        None, 'gzip' or 'bz2', or 'infer' to choose it from the file extension (.gz or .bz2)
+
+    Returns
+    -------
+    file object
+    """
+
+    if compression == 'infer':
+        compression = {'.gz': 'gzip', '.bz2': 'bz2'}.get(os.path.splitext(path)[1])
+
+    if compression == 'gzip':
+        return gzip.open(path, 'wt', encoding='UTF-8')
+    elif compression == 'bz2':
+        return bz2.open(path, 'wt', encoding='UTF-8')
+    elif compression is None:
+        return open(path, 'w', encoding='UTF-8')
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
+
+
+def _xml_attribute(value):
+    """
+    Stringify a value and escape it as a quoted XML attribute, like ElementTree does
+
+    Parameters
+    ----------
+    value : any
+
+    Returns
+    -------
+    str
+    """
+
+    return '"' + xml.sax.saxutils.escape(
+        str(value), {'"': '&quot;', '\r': '&#13;', '\n': '&#10;', '\t': '&#09;'}
+    ) + '"'
+
+
+def _records(df):
+    """
+    Convert the rows of a DataFrame into a list of dicts, without creating a Series per row
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+
+    Returns
+    -------
+    records : list
+        one dict per row, mapping column names to values
+    """
+
+    columns = list(df.columns)
+    return [dict(zip(columns, row)) for row in zip(*(df[column].tolist() for column in columns))]
+
+
+# marks attributes that a node or edge does not have, to distinguish them from attributes set to None
+_MISSING = object()
+
+# types that are stored as native arrow values in snapshots, if a column contains only one of them
+_SNAPSHOT_NATIVE_TYPES = {bool, int, float, str}
+
+
+def _snapshot_value(value):
+    """
+    Convert numpy scalars (e.g. lengths calculated by shapely) into python values, so that they can be stored natively
+
+    Parameters
+    ----------
+    value : any
+
+    Returns
+    -------
+    value : any
+    """
+
+    return value.item() if isinstance(value, (np.bool_, np.integer, np.floating, np.str_)) else value
 
-    # nodes dictionary, will be filled while creating ways
-    nodes = {}
-
-    # ways
-    for id, data in G.edges.items():
-
-        way = ET.SubElement(osm, 'way', attrib={
-            'id': str(next(osm_id)),  # assign a new unique osm id to each way
-            'version': '1',
-            'timestamp': '2000-01-01T00:00:00Z'
-        })
-
-        # way nodes
-        for i in [0, 0.5, 1]:
-
-            # first and last node
-            if i in [0, 1]:
-                this_id = id[i]
-                this_graph_node = G.nodes[this_id]
-                nodes[this_id] = shapely.geometry.Point(this_graph_node['x'], this_graph_node['y'])
-                # add node along the way, use the existing node id
-                ET.SubElement(way, 'nd', attrib={'ref': str(this_id)})
-
-            # intermediary nodes
-            elif i == 0.5:
-                linestring = data.get('geometry')
-                # iterate over all points along the linestring geometry but exclude the first ans last one
-                for point in linestring.coords[1:-1]:
-                    this_new_osm_id = next(osm_id)
-                    nodes[this_new_osm_id] = shapely.geometry.Point(point)
-                    # add node along the way, assign a new unique id
-                    ET.SubElement(way, 'nd', attrib={'ref': str(this_new_osm_id)})
-
-        # way tags
-        for tag in tags:
-            # skip if the tag is note defined for this way
-            if data.get(tag, None) is None:
-                continue
-            ET.SubElement(way, 'tag', attrib={
-                'k': tag,
-                'v': str(data.get(tag, ''))
-            })
-
-        if uv_tags:
-            ET.SubElement(way, 'tag', attrib={'k': '_u', 'v': str(id[0])})
-            ET.SubElement(way, 'tag', attrib={'k': '_v', 'v': str(id[1])})
-            ET.SubElement(way, 'tag', attrib={'k': '_key', 'v': str(id[2])})
-
-    # nodes
-    for id, point in nodes.items():
-        node = ET.SubElement(osm, 'node', attrib={
-            'id': str(id),
-            'version': '1',
-            'timestamp': '2000-01-01T00:00:00Z',
-            'lat': str(point.y),
-            'lon': str(point.x)
-        })
-
-        if tag_all_nodes:
-            ET.SubElement(node, 'tag', attrib={'k': '_node', 'v': 'true'})
-
-        # TODO: add other tags
-
-    # Save into xml file
-    tree._setroot(osm)
-    ET.indent(tree)
-    tree.write(path, encoding='UTF-8', xml_declaration=True)
+
+def _encode_snapshot_column(values):
+    """
+    Convert the values of one attribute into an arrow array, choosing the encoding that restores their exact types.
+    Numpy scalars are stored as the corresponding python values.
+
+    Parameters
+    ----------
+    values : list
+        attribute values, may contain None
+
+    Returns
+    -------
+    array : pa.Array
+    encoding : str
+        'native', 'wkb' or 'pickle'
+    """
+
+    values = [_snapshot_value(value) for value in values]
+    types = {type(value) for value in values if value is not None}
+
+    if all(isinstance(value, shapely.geometry.base.BaseGeometry) for value in values if value is not None) \
+            and len(types) > 0:
+        return pa.array(shapely.to_wkb(np.array(values, dtype=object)), type=pa.binary()), 'wkb'
+
+    if len(types) == 1 and types <= _SNAPSHOT_NATIVE_TYPES:
+        native = True
+    elif types == {list}:
+        item_types = {type(item) for value in values if value is not None for item in value}
+        native = len(item_types) <= 1 and item_types <= _SNAPSHOT_NATIVE_TYPES
+    else:
+        native = len(types) == 0
+
+    if native:
+        try:
+            return pa.array(values), 'native'
+        except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError):
+            pass
+
+    return pa.array([pickle.dumps(value) for value in values], type=pa.binary()), 'pickle'
+
+
+def _encode_snapshot_table(ids, data):
+    """
+    Convert the ids and attribute dicts of nodes or edges into an arrow table
+
+    Parameters
+    ----------
+    ids : list
+        one list of values per id component, e.g. [u, v, key] for edges
+    data : list
+        attribute dict of each node or edge
+
+    Returns
+    -------
+    table : pa.Table
+    """
+
+    arrays = []
+    fields = []
+
+    def add_column(name, values, role, attribute=''):
+        array, encoding = _encode_snapshot_column(values)
+        arrays.append(array)
+        fields.append(pa.field(name, array.type, metadata={
+            'role': role, 'encoding': encoding, 'attribute': attribute
+        }))
+
+    for i, values in enumerate(ids):
+        add_column(f'__id_{i}__', list(values), 'id')
+
+    attributes = dict.fromkeys(attribute for d in data for attribute in d)
+    for i, attribute in enumerate(attributes):
+        values = [d.get(attribute, _MISSING) for d in data]
+        present = [value is not _MISSING for value in values]
+        if not all(present):
+            values = [None if value is _MISSING else value for value in values]
+            add_column(f'__present_{i}__', present, 'present', attribute)
+        add_column(str(attribute), values, 'attribute', attribute)
+
+    return pa.Table.from_arrays(arrays, schema=pa.schema(fields))
+
+
+def _snapshot_isin(table, column, values):
+    """
+    Mask the rows of a snapshot table whose value in a column is one of the given values
+
+    Parameters
+    ----------
+    table : pa.Table
+    column : str
+    values : list
+
+    Returns
+    -------
+    mask : pa.ChunkedArray
+        boolean mask
+    """
+
+    field = table.schema.field(column)
+    values = [_snapshot_value(value) for value in values]
+    if field.metadata[b'encoding'] == b'pickle':
+        value_set = pa.array([pickle.dumps(value) for value in values], type=pa.binary())
+    else:
+        value_set = pa.array(values, type=field.type)
+    return pa.compute.is_in(table[column], value_set=value_set)
+
+
+def _decode_snapshot_column(column, encoding):
+    """
+    Convert an arrow column back into a list of python values
+
+    Parameters
+    ----------
+    column : pa.ChunkedArray
+    encoding : str
+        'native', 'wkb' or 'pickle'
+
+    Returns
+    -------
+    values : list
+    """
+
+    if encoding == 'wkb':
+        return list(shapely.from_wkb(column.to_numpy(zero_copy_only=False)))
+    elif encoding == 'pickle':
+        return [pickle.loads(value) for value in column.to_pylist()]
+    else:
+        return column.to_pylist()
+
+
+def _decode_snapshot_table(table):
+    """
+    Convert an arrow table created by _encode_snapshot_table() back into ids and attribute dicts
+
+    Parameters
+    ----------
+    table : pa.Table
+
+    Returns
+    -------
+    ids : list
+        id of each row, a tuple if the id has several components
+    data : list
+        attribute dict of each row
+    """
+
+    id_columns = []
+    attribute_columns = []
+    present = {}
+    for field, column in zip(table.schema, table.columns):
+        role = field.metadata[b'role'].decode()
+        values = _decode_snapshot_column(column, field.metadata[b'encoding'].decode())
+        attribute = field.metadata[b'attribute'].decode()
+        if role == 'id':
+            id_columns.append(values)
+        elif role == 'present':
+            present[attribute] = values
+        else:
+            attribute_columns.append((attribute, values))
+
+    ids = id_columns[0] if len(id_columns) == 1 else list(zip(*id_columns))
+    data = [{} for _ in range(table.num_rows)]
+    for attribute, values in attribute_columns:
+        if attribute in present:
+            for d, value, is_present in zip(data, values, present[attribute]):
+                if is_present:
+                    d[attribute] = value
+        else:
+            for d, value in zip(data, values):
+                d[attribute] = value
+
+    return ids, data
 
 
 def _iterable_columns_from_strings(df, columns, method='separator', separator=','):
@@ -562,9 +1384,43 @@ def _iterable_columns_from_strings(df, columns, method='separator', separator=',
     for column in columns:
         if column in df:
             if method == 'separator':
-                df[column] = df[column].apply(lambda x: x.split(separator))
+                df[column] = df[column].str.split(separator, regex=False)
             elif method == 'str':
-                df[column] = df[column].apply(lambda x: json.loads(x) if x != 'nan' else [])
+                # decode the whole column with a single json call
+                values = df[column].where(~(df[column].isna() | (df[column] == 'nan')), '[]')
+                df[column] = pd.Series(json.loads('[' + ','.join(values) + ']'), index=df.index, dtype=object)
+
+
+def _json_column(series):
+    """
+    Encode each value of a Series as JSON
+
+    Flat lists of integers, booleans or strings are encoded all at once by pandas, other values (e.g. dicts or floats)
+    one by one with json.dumps, because pandas limits the precision of floats.
+
+    Parameters
+    ----------
+    series : pd.Series
+
+    Returns
+    -------
+    list
+        JSON string of each value
+    """
+
+    # dicts would be exploded into their keys, so only lists qualify
+    is_list = {type(value) for value in series if value is not None} <= {list}
+    if is_list and pd.api.types.infer_dtype(series.explode(), skipna=True) in {'integer', 'boolean', 'string', 'empty'}:
+        try:
+            # one JSON record per line, the line breaks within the values are escaped
+            lines = pd.DataFrame({'v': series.to_numpy()}).to_json(orient='records', lines=True).split('\n')
+            # strip the '{"v":' and '}' around each value
+            return pd.Series(lines[:len(series)]).str[5:-1].tolist()
+        except OverflowError:
+            # integers that do not fit into 64 bits
+            pass
+
+    return list(map(json.dumps, series))
 
 
 def _stringify_iterable_columns(df, columns, method='separator', separator=','):
@@ -591,6 +1447,10 @@ def _stringify_iterable_columns(df, columns, method='separator', separator=','):
     for column in columns:
         if column in df:
             if method == 'separator':
-                df[column] = df[column].apply(lambda x: separator.join(x))
+                joined = df[column].str.join(separator)
+                # str.join results in NaN for values that are not lists of strings
+                if joined.isna().any():
+                    raise TypeError(f"Column '{column}' must only contain iterables of strings")
+                df[column] = joined
             elif method == 'str':
-                df[column] = df[column].apply(lambda x: json.dumps(x))
+                df[column] = _json_column(df[column])
@@ -5,34 +5,83 @@ import numpy as np
 import itertools as it
 
 
-def merge_parallel_edges(G):
+def merge_parallel_edges(G, max_offset=None, nodes=None):
     """
     Detect and merge all sets of edges sharing the same start/end nodes, incl. their attributes
-    TODO: Avoid merging edges that are too far apart, e.g. parallel streets
 
     Parameters
     ----------
     G : nx.MultiGraph
         street graph
+    max_offset : float
+        maximum distance between the geometries of parallel edges that are merged into one street,
+        in the units of the graph's crs, None -> no limit.
+        Edges of a group that are further apart, e.g. parallel streets, are merged only with their closer neighbors
+    nodes : iterable
+        only consider edges adjacent to these nodes, None -> all edges
 
     Returns
     -------
-    None
+    counts : dict
+        * 'groups': number of merged groups of parallel edges
+        * 'merged_edges': number of edges that have been merged
+        * 'changed_nodes': set of nodes whose adjacent edges have changed
     """
 
+    counts = {'groups': 0, 'merged_edges': 0, 'changed_nodes': set()}
+
+    if nodes is not None:
+        nodes = [node for node in nodes if node in G]
+
     uv_index = {}
-    for edge in G.edges(data=True, keys=True):
+    for edge in G.edges(nbunch=nodes, data=True, keys=True):
         # Group edges by start/end nodes and layer
-        uv_key = ','.join([str(min(edge[0:2])), str(max(edge[0:2])), str(edge[3].get('layer'))])
-        if uv_key not in uv_index:
-            uv_index[uv_key] = []
-        uv_index[uv_key].append(edge)
+        uv_key = (min(edge[0:2]), max(edge[0:2]), edge[3].get('layer'))
+        uv_index.setdefault(uv_key, []).append(edge)
 
     # Merge each set of grouped edges
     for uv_key, edge_list in uv_index.items():
-        if len(edge_list) > 1:
-            _merge_given_parallel_edges(G, edge_list)
-            pass
+        if len(edge_list) < 2:
+            continue
+        if max_offset is None:
+            edge_sublists = [edge_list]
+        else:
+            edge_sublists = _split_by_offset(edge_list, max_offset)
+        for edge_sublist in edge_sublists:
+            if len(edge_sublist) > 1:
+                _merge_given_parallel_edges(G, edge_sublist)
+                counts['groups'] += 1
+                counts['merged_edges'] += len(edge_sublist)
+                counts['changed_nodes'].update(uv_key[0:2])
+
+    return counts
+
+
+def _split_by_offset(edges, max_offset):
+    """
+    Split a group of parallel edges into subgroups of edges that lie close to each other
+
+    Parameters
+    ----------
+    edges : list
+        list of parallel edges
+    max_offset : float
+        maximum gap between the offsets of neighboring edges within a subgroup
+
+    Returns
+    -------
+    list
+        a list of edge lists
+    """
+
+    offsets = np.array(geometry_tools._offset_distance([edge[3].get('geometry') for edge in edges]))
+    order = np.argsort(offsets)
+    subgroups = [[edges[order[0]]]]
+    for previous, current in zip(order[:-1], order[1:]):
+        if offsets[current] - offsets[previous] > max_offset:
+            subgroups.append([])
+        subgroups[-1].append(edges[current])
+    return subgroups
 
 
 def _merge_given_parallel_edges(G, edges):
@@ -98,110 +147,178 @@ def _merge_given_parallel_edges(G, edges):
     parent_edge[3]['hierarchy'] = min([edge[3].get('hierarchy') for edge in edges])
 
 
-def merge_consecutive_edges(G):
+def merge_consecutive_edges(G, nodes=None):
     """
     Merge edges such that the graph contains no unnecessary nodes with degree=2
-    
+
+    Chains of consecutive edges are extracted in a single pass by walking from every node that is not a
+    degree=2 node along the maximal paths of degree=2 nodes, so each chain is merged at once, regardless of its length.
+
     Parameters
     ----------
     G : ox.MultiGraph
         street graph
-    
+    nodes : iterable
+        only consider chains that contain or end at these nodes, None -> all chains
+
     Returns
     -------
-    None
+    counts : dict
+        * 'chains': number of merged edge chains
+        * 'merged_edges': number of edges that have been merged
+        * 'removed_nodes': number of intermediary nodes that have been removed
+        * 'changed_nodes': set of nodes whose adjacent edges have changed
     """
 
-    # Initialize 'consec_id' edge labels
-    for edge in G.edges(data=True, keys=True):
-        edge[3]['consec_id'] = None
-
-    # Label edges by consecutive clusters
-    for node in G.nodes:
-        # Find all nodes having only two adjacent edges
-        if G.degree(node) == 2:
-            edges = list(G.edges(node, data=True, keys=True))
-            # Start with the first adjacent edge and identify next edges to work on
-            edge = edges[0]
-            next_edges = _label_edge(G, edge)
-            # Repeat for each next_edge multiple times until entire clusters of consecutive edges are processed
-            for i in range(3):
-                next_edges = _label_edges(G, next_edges)
-
-    # Group edges by clusters
-    edge_clusters = {}
-    for edge in G.edges(data=True, keys=True):
-        consec_id = edge[3].get('consec_id')
-        # Ignore edges that are in no cluster
-        if consec_id is None:
-            continue
-        if consec_id not in edge_clusters:
-            edge_clusters[consec_id] = []
-        edge_clusters[consec_id].append(edge)
+    counts = {'chains': 0, 'merged_edges': 0, 'removed_nodes': 0, 'changed_nodes': set()}
 
-    # Merge edges within each cluster
-    for key, edge_cluster in edge_clusters.items():
-        _merge_given_consecutive_edges(G, edge_cluster)
-        pass
+    for edge_chain in _find_consecutive_edge_chains(G, nodes=nodes):
+        chain_counts = _merge_given_consecutive_edges(G, edge_chain)
+        for key, value in chain_counts.items():
+            if key == 'changed_nodes':
+                counts[key].update(value)
+            else:
+                counts[key] += value
 
+    return counts
 
-def _merge_given_consecutive_edges(G, edges):
+
+def _is_chain_node(G, node):
     """
-    Merge the consecutive edges in a given list
+    Check if a node connects exactly two edges that can be merged, i.e. it has degree=2 and no self-loop
 
     Parameters
     ----------
     G : nx.MultiGraph
         street graph
-    edges : list
-        list of edges to be merged
+    node : int
 
     Returns
     -------
-    None
+    bool
     """
 
-    nodes = []
-    for edge in edges:
-        nodes += edge[0:2]
-
-    # Nodes that are adjacent to one edge -> outer nodes
-    outer_nodes = [node for node in nodes if nodes.count(node) == 1]
-    outer_nodes.sort()
+    return G.degree(node) == 2 and not G.has_edge(node, node)
 
-    # Nodes that are adjacent to two edges -> middle nodes
-    middle_nodes = [node for node in nodes if nodes.count(node) == 2]
-    middle_nodes.sort()
 
-    edge_chain = []
+def _find_consecutive_edge_chains(G, nodes=None):
+    """
+    Find all maximal chains of consecutive edges, i.e. paths whose intermediary nodes all have degree=2.
+    Each chain is a list of edges ordered from one end to the other, with the edges oriented (u, v) along the chain.
+    Chains starting and ending at the same node and isolated cycles are left out.
 
-    # Stop here if the edge chain is corrupted
-    # TODO: Why is this happening?
-    if len(outer_nodes) != 2:
-        #print('edge chain corrupted')
-        return
+    Parameters
+    ----------
+    G : nx.MultiGraph
+        street graph
+    nodes : iterable
+        only find chains that contain or end at these nodes, None -> all chains
 
-    # Start with the first outer node
-    node = outer_nodes[0]
-    previous_edge = None
+    Returns
+    -------
+    chains : list
+        a list of lists of full edge tuples
+    """
 
-    # Do until reaching the other outer node
-    while node != outer_nodes[1]:
-        for edge in edges:
+    if nodes is None:
+        start_nodes = G.nodes
+    else:
+        start_nodes = set()
+        for node in nodes:
+            if node not in G:
+                continue
+            if _is_chain_node(G, node):
+                # walk to one end of the chain, the chain will be found from there
+                start_nodes.add(_find_chain_end(G, node))
+            else:
+                start_nodes.add(node)
+        start_nodes.discard(None)
+
+    visited = set()
+    chains = []
+
+    for start_node in start_nodes:
+        # chains start and end at nodes that are not degree=2 nodes
+        if _is_chain_node(G, start_node):
+            continue
 
-            # Ignore the previous edge
-            if edge is previous_edge:
+        for edge in G.edges(start_node, keys=True, data=True):
+            key = graph_tools._edge_key(edge, directed=False)
+            if key in visited:
                 continue
+            visited.add(key)
+
+            # walk along the degree=2 nodes until the end of the chain
+            chain = [edge]
+            node = edge[1]
+            while _is_chain_node(G, node) and node != start_node:
+                next_edge = [
+                    candidate for candidate in G.edges(node, keys=True, data=True)
+                    if graph_tools._edge_key(candidate, directed=False) != key
+                ][0]
+                key = graph_tools._edge_key(next_edge, directed=False)
+                visited.add(key)
+                chain.append(next_edge)
+                node = next_edge[1]
+
+            if len(chain) > 1 and node != start_node:
+                chains.append(chain)
+
+    return chains
+
+
+def _find_chain_end(G, node):
+    """
+    Walk from a degree=2 node along its chain until reaching a node that is not a degree=2 node
+
+    Parameters
+    ----------
+    G : nx.MultiGraph
+        street graph
+    node : int
+        a degree=2 node
+
+    Returns
+    -------
+    int
+        the end node of the chain, None if the chain is an isolated cycle
+    """
+
+    start_node = node
+    edge = next(iter(G.edges(node, keys=True)))
+    key = graph_tools._edge_key(edge, directed=False)
+    node = edge[1]
+    while _is_chain_node(G, node):
+        if node == start_node:
+            return None
+        edge = [
+            candidate for candidate in G.edges(node, keys=True)
+            if graph_tools._edge_key(candidate, directed=False) != key
+        ][0]
+        key = graph_tools._edge_key(edge, directed=False)
+        node = edge[1]
+    return node
+
+
+def _merge_given_consecutive_edges(G, edge_chain):
+    """
+    Merge the consecutive edges in a given chain
+
+    Parameters
+    ----------
+    G : nx.MultiGraph
+        street graph
+    edge_chain : list
+        list of edges to be merged, ordered along the chain and oriented (u, v) along the chain,
+        as returned by _find_consecutive_edge_chains
 
-            # Append edge in ordinary direction
-            elif edge[0] == node:
-                edge_chain.append(edge)
-                node = edge[1]
+    Returns
+    -------
+    counts : dict
+        number of merged chains, edges, and removed nodes, and the changed nodes
+    """
 
-            # Append edge in reversed direction
-            elif edge[1] == node:
-                edge_chain.append(edge)
-                node = edge[0]
+    counts = {'chains': 0, 'merged_edges': 0, 'removed_nodes': 0, 'changed_nodes': set()}
 
     # Split the edge chain into subchains based on permitted modes
     edge_subchains = []
@@ -220,42 +337,41 @@ def _merge_given_consecutive_edges(G, edges):
         if len(edge_subchain) < 2:
             continue
 
-        # Find subchain outer nodes
-        subchain_nodes = []
-        for edge in edge_subchain:
-            subchain_nodes += edge[0:2]
-        subchain_outer_nodes = list(set([node for node in subchain_nodes if subchain_nodes.count(node) == 1]))
-        subchain_outer_nodes.sort()
-        subchain_middle_nodes = list(set([node for node in subchain_nodes if subchain_nodes.count(node) > 1]))
-        subchain_middle_nodes.sort()
-
-        # Reverse edge geometries if necessary
-        node = subchain_outer_nodes[0]
+        # Orient the subchain from the lower to the higher outer node
+        if edge_subchain[0][0] > edge_subchain[-1][1]:
+            edge_subchain = [(edge[1], edge[0], edge[2], edge[3]) for edge in reversed(edge_subchain)]
+
+        subchain_nodes = [edge[0] for edge in edge_subchain] + [edge_subchain[-1][1]]
+        subchain_outer_nodes = [subchain_nodes[0], subchain_nodes[-1]]
+        subchain_middle_nodes = sorted(subchain_nodes[1:-1])
+
+        # Reverse edge geometries if necessary, so that they all follow the direction of the subchain
         for edge in edge_subchain:
-            edge[3]['__previous_node'] = node
-            if node == edge[0]:
-                node = edge[1]
-            elif node == edge[1]:
+            edge[3]['__previous_node'] = edge[0]
+            edge[3]['__next_node'] = edge[1]
+            if not _is_geometry_oriented(G, edge):
                 graph_tools._reverse_edge(G, edge, reverse_topology=False)
-                node = edge[0]
-            edge[3]['__next_node'] = node
 
         # Find the longest edge
-        sorted_edges = sorted(edge_subchain, key=lambda x: x[3].get('length'))
-        longest_edge = sorted_edges[-1]
+        longest_edge = max(edge_subchain, key=lambda x: x[3].get('length'))
 
         # Initialize the merged edge based on the longest edge
         merged_data = longest_edge[3].copy()
 
         # Merge geometries
         geometries = [edge[3]['geometry'] for edge in edge_subchain]
-        for i in range(2):
+        if all(geom.geom_type == 'LineString' for geom in geometries):
+            # the geometries are oriented along the subchain, so their coordinates can be chained directly
+            coords = [geometries[0].coords[0]]
+            for geom in geometries:
+                coords.extend(geom.coords[1:])
+            merged_line = geometry.LineString(coords)
+        else:
             geometries = [
                 (lambda geom: (ops.linemerge(geom) if geom.geom_type == 'MultiLineString' else geom))(geom)
                 for geom in geometries
             ]
-        multi_line = geometry.MultiLineString(geometries)
-        merged_line = ops.linemerge(multi_line)
+            merged_line = ops.linemerge(geometry.MultiLineString(geometries))
         merged_data['geometry'] = merged_line
         # Update length
         merged_data['length'] = merged_line.length
@@ -279,83 +395,44 @@ def _merge_given_consecutive_edges(G, edges):
         # Delete the old edges
         for edge in edge_subchain:
             G.remove_edge(edge[0], edge[1], edge[2])
-            pass
 
         # Delete the intermediary nodes
-        for node in subchain_middle_nodes:
-            G.remove_node(node)
+        G.remove_nodes_from(subchain_middle_nodes)
 
         # Create a new merged edge
         G.add_edge(subchain_outer_nodes[0], subchain_outer_nodes[1], **merged_data)
 
+        counts['chains'] += 1
+        counts['merged_edges'] += len(edge_subchain)
+        counts['removed_nodes'] += len(subchain_middle_nodes)
+        counts['changed_nodes'].update(subchain_outer_nodes)
 
-def _label_edge(G, edge):
-    """
-    Assign the edge to a bunch of consecutive edges (that can be merged)
-
-    Parameters
-    ----------
-    G : nx.MultiGraph
-        street graph
-    edge : tuple
-        full edge tuple
-
-    Returns
-    -------
-    next_edges : list
-        a list of edges to be labeled next
-    """
-
-    neighbors_groups = graph_tools._get_neighbors(G, edge)
-    edge[3]['neighbors'] = str([len(group) for group in neighbors_groups])
-    neighbors_groups.append([edge])
-    next_edges = []
-    consecutive_cluster_id = None
-
-    for neighbors_group in neighbors_groups:
-        # Discard neighbor groups with multiple edges, indicating that the node has >2 adjacent edges
-        if len(neighbors_group) != 1:
-            continue
-
-        neighbor = neighbors_group[0]
-        # Add to next_edges if it has not been processed yet (i.e. has no consec_id)
-        neighbor[3].get('consec_id') or next_edges.append(neighbor)
-        # If it has a consec_id, take it over
-        consecutive_cluster_id = consecutive_cluster_id or neighbor[3].get('consec_id')
-
-    # If no consec_id was found, assign a new one based on the own edge_hash
-    consecutive_cluster_id = consecutive_cluster_id or graph_tools._edge_hash(edge)
-
-    # Write the consec_id into all edges of the cluster
-    for edge in next_edges:
-        #print(consecutive_cluster_id)
-        edge[3]['consec_id'] = consecutive_cluster_id
-        pass
+    return counts
 
-    return next_edges
 
-
-def _label_edges(G, edges):
+def _is_geometry_oriented(G, edge):
     """
-    Assign all edges in a list to bunches of consecutive edges
+    Check if the geometry of an edge runs from its u node to its v node,
+    by comparing the start of the geometry with the coordinates of both nodes
 
     Parameters
     ----------
     G : nx.MultiGraph
         street graph
-    edges : list
-        list of full edge tuples
+    edge : tuple
+        full edge tuple
 
     Returns
     -------
-    next_edges : list
-        a list of edges to be labeled next
+    bool
     """
 
-    next_edges = []
-    for edge in edges:
-        result = _label_edge(G, edge)
-        if (len(result) > 0):
-            next_edges += result
-
-    return next_edges
+    geom = edge[3].get('geometry')
+    if geom is None or geom.is_empty:
+        return True
+    if geom.geom_type == 'MultiLineString':
+        geom = geom.geoms[0]
+    x, y = geom.coords[0][0:2]
+    u = G.nodes[edge[0]]
+    v = G.nodes[edge[1]]
+    return (x - u['x']) ** 2 + (y - u['y']) ** 2 <= (x - v['x']) ** 2 + (y - v['y']) ** 2
@@ -7,6 +7,7 @@ import geopandas as gpd
 import networkx as nx
 import numpy as np
 import pandas as pd
+import shapely
 from shapely.geometry import LineString
 from shapely.geometry import Point
 
@@ -329,7 +330,7 @@ def get_digraph(G, weight="length"):
     return nx.DiGraph(G)
 
 
-def get_undirected(G):
+def get_undirected(G, fast=False):
     """
     Convert MultiDiGraph to undirected MultiGraph.
 
@@ -340,11 +341,19 @@ def get_undirected(G):
     ----------
     G : networkx.MultiDiGraph
         input graph
+    fast : bool
+        if True, detect duplicate edges in a single pass by hashing their
+        osmid and direction-normalised coordinates instead of comparing
+        parallel edges pairwise, and build the MultiGraph without copying G
+        first. The result is the same as with the pairwise comparison.
 
     Returns
     -------
     networkx.MultiGraph
     """
+    if fast:
+        return _get_undirected_fast(G)
+
     # make a copy to not mutate original graph object caller passed in
     G = G.copy()
 
@@ -396,6 +405,117 @@ def get_undirected(G):
     return H
 
 
+def _get_undirected_fast(G):
+    """
+    Convert MultiDiGraph to undirected MultiGraph in a single pass.
+
+    Follows the same steps as the pairwise comparison in `get_undirected`,
+    but compares edges by hashing their direction-normalised coordinates:
+    opposite edges with the same key are merged into one edge, whose
+    attributes (including from/to and the geometry's orientation) are those
+    of the edge that comes later in G, unless their geometries differ, in
+    which case the first one gets a new key. Of the remaining edges with the
+    same nodes, osmid and geometry, the first one is kept.
+
+    Parameters
+    ----------
+    G : networkx.MultiDiGraph
+        input graph
+
+    Returns
+    -------
+    networkx.MultiGraph
+    """
+    edges = list(G.edges(keys=True, data=True))
+
+    # set from/to nodes and fill missing geometries with straight lines
+    new_edges = []
+    for u, v, k, d in edges:
+        data = dict(d)
+        data["from"] = u
+        data["to"] = v
+        if "geometry" not in data:
+            point_u = (G.nodes[u]["x"], G.nodes[u]["y"])
+            point_v = (G.nodes[v]["x"], G.nodes[v]["y"])
+            data["geometry"] = LineString([point_u, point_v])
+        new_edges.append([u, v, k, data])
+
+    geometry_keys = _geometry_keys([data["geometry"] for u, v, k, data in new_edges])
+
+    # increment the key of the first of opposite edges that share a key but
+    # differ in geometry, so that they are not merged below. like in
+    # _update_edge_keys, the edge is re-added and thereby moves to the end of
+    # its adjacency, so keep track of the adjacency order without copying G
+    adjacency = {node: {} for node in G.nodes}
+    groups = {}
+    for edge, geometry_key in zip(new_edges, geometry_keys):
+        u, v, k, data = edge
+        adjacency[u].setdefault(v, {})[k] = edge
+        groups.setdefault((frozenset((u, v)), k), []).append((edge, geometry_key))
+    different_streets = {
+        tuple(group[0][0][:3])
+        for group in groups.values()
+        if len({geometry_key for edge, geometry_key in group}) > 1
+    }
+    for u, v, k in different_streets:
+        edge = adjacency[u][v].pop(k)
+        if not adjacency[u][v]:
+            del adjacency[u][v]
+        new_key = max(list(adjacency[u].get(v, {})) + list(adjacency[v].get(u, {})) + [k]) + 1
+        edge[2] = new_key
+        adjacency[u].setdefault(v, {})[new_key] = edge
+    new_edges = [edge for nbrs in adjacency.values() for keys in nbrs.values() for edge in keys.values()]
+
+    # convert MultiDiGraph to MultiGraph, merging opposite edges with the same key
+    H = nx.MultiGraph(**G.graph)
+    H.add_nodes_from(G.nodes(data=True))
+    H.add_edges_from(new_edges)
+
+    # remove the remaining duplicates, keeping the first one
+    h_edges = list(H.edges(keys=True, data=True))
+    geometry_keys = _geometry_keys([data["geometry"] for u, v, k, data in h_edges])
+    seen = set()
+    duplicate_edges = []
+    for (u, v, k, data), geometry_key in zip(h_edges, geometry_keys):
+        osmid = data.get("osmid")
+        osmid = frozenset(osmid) if isinstance(osmid, list) else osmid
+        key = (frozenset((u, v)), osmid, geometry_key)
+        if key in seen:
+            duplicate_edges.append((u, v, k))
+        else:
+            seen.add(key)
+
+    H.remove_edges_from(duplicate_edges)
+    utils.log("Converted MultiDiGraph to undirected MultiGraph")
+
+    return H
+
+
+def _geometry_keys(geometries):
+    """
+    Hash the 2d coordinates of geometries independently of their direction.
+
+    Of the forward and reversed byte representation of the coordinates, the
+    smaller one is used, which is the same for both directions.
+
+    Parameters
+    ----------
+    geometries : list
+        shapely geometries
+
+    Returns
+    -------
+    list of bytes
+    """
+    coords, index = shapely.get_coordinates(np.array(geometries, dtype=object), return_index=True)
+    bounds = np.searchsorted(index, np.arange(len(geometries) + 1))
+    keys = []
+    for i in range(len(geometries)):
+        c = coords[bounds[i] : bounds[i + 1]]
+        keys.append(min(c.tobytes(), c[::-1].tobytes()))
+    return keys
+
+
 def _is_duplicate_edge(data1, data2):
     """
     Check if two graph edge data dicts have the same osmid and geometry.
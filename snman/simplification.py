@@ -2,12 +2,56 @@ import geopandas as gpd
 import pandas as pd
 import shapely as shp
 from . import osmnx_customized as oxc
-from . import io, geometry_tools
+from . import io, geometry_tools, graph_tools, merge_edges
 import networkx as nx
+import numpy as np
 import itertools as it
+import multiprocessing as mp
 
 
-def merge_nodes_geometric(G, tolerance, given_intersections_gdf=None, regions_gdf=None):
+def _union_buffers(buffers, clip_geometry=None):
+    """
+    Merge buffer polygons into intersection polygons, optionally clipped with a region polygon
+
+    Parameters
+    ----------
+    buffers : np.ndarray
+        array of polygons
+    clip_geometry : shp.geometry.Polygon or shp.geometry.MultiPolygon
+        region polygon
+
+    Returns
+    -------
+    list
+        individual polygons
+    """
+
+    union = shp.union_all(buffers)
+    if clip_geometry is not None:
+        union = shp.intersection(union, clip_geometry)
+    parts = shp.get_parts(union)
+    # clipping can leave lines or points along the region boundaries, keep only the polygons
+    return list(parts[shp.get_type_id(parts) == 3])
+
+
+def _union_buffers_of_regions(tasks):
+    """
+    Apply _union_buffers to a list of (buffers, clip_geometry) tuples (for multiprocessing)
+
+    Parameters
+    ----------
+    tasks : list
+
+    Returns
+    -------
+    list
+        individual polygons
+    """
+
+    return list(it.chain.from_iterable(_union_buffers(*task) for task in tasks))
+
+
+def merge_nodes_geometric(G, tolerance, given_intersections_gdf=None, regions_gdf=None, cpus=1):
     """
     Create intersection geometries.
     Optionally use given intersection geometries to locally override the auto-detected results
@@ -24,6 +68,8 @@ def merge_nodes_geometric(G, tolerance, given_intersections_gdf=None, regions_gd
     regions_gdf : gpd.GeoDataFrame
         simplification regions,
         created by .io.load_regions()
+    cpus : int
+        how many CPU cores to use for merging the buffers of the regions; if None, use all available
 
     Returns
     -------
@@ -37,53 +83,64 @@ def merge_nodes_geometric(G, tolerance, given_intersections_gdf=None, regions_gd
     # exclude nodes already covered by given intersections
     # this is important to get rid of residuals from the buffers after subtracting the given intersections
     if given_intersections_gdf is not None:
-        G_gdf = G_gdf[~G_gdf.within(given_intersections_gdf.unary_union)]
+        given_intersections = shp.union_all(given_intersections_gdf.geometry.to_numpy())
+        # the prepared geometry is only used if it is the first argument of the predicate
+        shp.prepare(given_intersections)
+        G_gdf = G_gdf[~shp.contains(given_intersections, G_gdf.geometry.to_numpy())]
+
+    points = G_gdf.geometry.to_numpy()
+    # use a small buffer for those nodes that have less than 3 streets
+    # this way, we avoid the creation of large intersections through chaining of unnecessary nodes
+    small_buffer = G_gdf['street_count'].to_numpy(dtype=float) < 3
 
     if regions_gdf is None:
-        # buffer nodes GeoSeries then get unary union to merge overlaps
-        auto_intersections = (
-            G_gdf["geometry"]
-                .buffer(list(map(lambda n_streets: 1 if n_streets<3 else tolerance,G_gdf.street_count)))
-                .unary_union
-        )
+        # buffer nodes then get unary union to merge overlaps
+        buffers = shp.buffer(points, np.where(small_buffer, 1, tolerance), quad_segs=16)
+        auto_intersections = _union_buffers(buffers)
     else:
-        # for every region, create buffers and clip them with the region polygon
-        auto_intersections = regions_gdf.apply(
-            lambda region: shp.geometry.MultiPolygon(
-                G_gdf["geometry"]
-                    # use a small buffer for those nodes that have less than 3 streets
-                    # this way, we avoid the creation of large intersections through chaining of unnecessary nodes
-                    .buffer(
-                        list(
-                            map(
-                                lambda n_streets: 1 if n_streets<3 else region.tolerance,
-                                G_gdf.street_count
-                            )
-                        )
-                    )
-                    .unary_union
-                    .intersection(region.geometry)
-            ),
-            axis=1
-        )
-        # create a list of lists with individual polygons
-        auto_intersections = list(map(lambda multipolygon: multipolygon.geoms, auto_intersections))
-        # flatten into a single list of polygons
-        auto_intersections = list(it.chain.from_iterable(auto_intersections))
-        # convert into a single multipolygon (across all regions)
-        auto_intersections = shp.geometry.MultiPolygon(auto_intersections)
-
-
-    if given_intersections_gdf is not None:
-        given_intersections = geometry_tools.ensure_multipolygon(given_intersections_gdf['geometry'].unary_union)
-        # subtract the given intersection from every detected intersection separately to avoid a unary union of
-        # the resulting geometries
-        auto_intersections = list(
-            map(lambda geom:
-                geometry_tools.ensure_multipolygon(geom.difference(given_intersections)),
-                list(auto_intersections.geoms)
+        # for every region, merge the buffers of the nodes that can reach into it and clip them with the region polygon
+        tree = shp.STRtree(points)
+        buffers = {}
+        tasks = []
+        for region_geometry, region_tolerance in zip(regions_gdf.geometry.to_numpy(), regions_gdf['tolerance']):
+            # buffer all nodes only once per tolerance value
+            if region_tolerance not in buffers:
+                radii = np.where(small_buffer, 1, region_tolerance)
+                buffers[region_tolerance] = shp.buffer(points, radii, quad_segs=16)
+            idx = tree.query(region_geometry, predicate='dwithin', distance=max(region_tolerance, 1))
+            tasks.append((buffers[region_tolerance][idx], region_geometry))
+
+        if cpus is None:
+            cpus = mp.cpu_count()
+        cpus = min(cpus, mp.cpu_count())
+
+        if cpus == 1 or len(tasks) < 2:
+            auto_intersections = _union_buffers_of_regions(tasks)
+        else:
+            # divide regions into equal-sized chunks for multiprocessing
+            size = int(np.ceil(len(tasks) / cpus))
+            args = ((tasks[i : i + size],) for i in range(0, len(tasks), size))
+            pool = mp.Pool(cpus)
+            sma = pool.starmap_async(_union_buffers_of_regions, args)
+            results = sma.get()
+            pool.close()
+            pool.join()
+            auto_intersections = list(it.chain.from_iterable(results))
+
+    if given_intersections_gdf is not None and len(auto_intersections) > 0:
+        # subtract the given intersections from every detected intersection separately to avoid a unary union of
+        # the resulting geometries, each detected intersection only against the given intersections it overlaps
+        given_geometries = given_intersections_gdf.geometry.to_numpy()
+        auto_idx, given_idx = shp.STRtree(given_geometries).query(auto_intersections, predicate='intersects')
+        overlapping = {}
+        for i, j in zip(auto_idx, given_idx):
+            overlapping.setdefault(i, []).append(j)
+        auto_intersections = [
+            geometry_tools.ensure_multipolygon(
+                geom.difference(shp.union_all(given_geometries[overlapping[i]])) if i in overlapping else geom
             )
-        )
+            for i, geom in enumerate(auto_intersections)
+        ]
 
     auto_intersections = gpd.GeoSeries(auto_intersections, crs=G.graph["crs"])
 
@@ -147,30 +204,35 @@ def consolidate_intersections(G, intersections_gdf, reconnect_edges=True):
     # nodes together that are not truly connected, e.g., nearby deadends or
     # surface streets with bridge).
 
-    groups = gdf.groupby("cluster")
-    for cluster_label, nodes_subset in groups:
-        if len(nodes_subset) > 1:
-            Gs = G.subgraph(nodes_subset.index).copy()
-            # Ignore pedestrian links for the detection of weakly connected components
-            #for id, edge in Gs.copy().edges.items():
-            #    if edge.get('highway') in {'path', 'footway', 'steps'}:
-            #        Gs.remove_edge(*id)
-            # identify all the (weakly connected) component in cluster
-            wccs = list(nx.weakly_connected_components(Gs))
-            if len(wccs) > 0:
-                # if there are multiple components in this cluster
-                suffix = 0
-                for wcc in wccs:
-                    # set subcluster xy to the centroid of just these nodes
-                    idx = list(wcc)
-                    subcluster_centroid = node_points.loc[idx].unary_union.centroid
-                    gdf.loc[idx, "x"] = subcluster_centroid.x
-                    gdf.loc[idx, "y"] = subcluster_centroid.y
-                    # move to subcluster by appending suffix to cluster label
-                    gdf.loc[idx, "cluster"] = f"{cluster_label}-{suffix}"
-                    suffix += 1
-
-
+    cluster_sizes = gdf["cluster"].map(gdf["cluster"].value_counts())
+    in_multi_node_cluster = (cluster_sizes > 1).to_numpy()
+    if in_multi_node_cluster.any():
+        multi = gdf[in_multi_node_cluster]
+        cluster_of = dict(zip(multi.index, multi["cluster"]))
+        # identify all the (weakly connected) components in all clusters at once,
+        # using only the edges between nodes of the same cluster
+        labels = graph_tools._union_find_labels(
+            multi.index,
+            (
+                (u, v) for u, v in G.edges()
+                if u in cluster_of and v in cluster_of and cluster_of[u] == cluster_of[v]
+            )
+        )
+        components = multi.index.map(labels).to_numpy()
+        # set subcluster xy to the centroid of just these nodes
+        coords = pd.DataFrame({
+            "x": node_points.loc[multi.index].geometry.x.to_numpy(),
+            "y": node_points.loc[multi.index].geometry.y.to_numpy(),
+            "component": components,
+        })
+        centroids = coords.groupby("component")[["x", "y"]].transform("mean")
+        # move each component to its own subcluster by appending a suffix to the cluster label
+        gdf["cluster"] = gdf["cluster"].astype(object)
+        gdf.loc[in_multi_node_cluster, "x"] = centroids["x"].to_numpy()
+        gdf.loc[in_multi_node_cluster, "y"] = centroids["y"].to_numpy()
+        gdf.loc[in_multi_node_cluster, "cluster"] = [
+            f"{cluster_label}-{component}" for cluster_label, component in zip(multi["cluster"], components)
+        ]
 
     # give nodes unique integer IDs (subclusters with suffixes are strings)
     gdf["cluster"] = gdf["cluster"].factorize()[0]
@@ -222,10 +284,11 @@ def consolidate_intersections(G, intersections_gdf, reconnect_edges=True):
 
     # STEP 6
     # create new edge from cluster to cluster for each edge in original graph
-    gdf_edges = oxc.utils_graph.graph_to_gdfs(G, nodes=False)
+    cluster_of = dict(zip(gdf.index, gdf["cluster"]))
+    new_edges = []
     for u, v, k, data in G.edges(keys=True, data=True):
-        u2 = gdf.loc[u, "cluster"]
-        v2 = gdf.loc[v, "cluster"]
+        u2 = cluster_of[u]
+        v2 = cluster_of[v]
 
         # only create the edge if we're not connecting the cluster
         # to itself, but always add original self-loops
@@ -233,35 +296,204 @@ def consolidate_intersections(G, intersections_gdf, reconnect_edges=True):
             data["u_original"] = u
             data["v_original"] = v
             if "geometry" not in data:
-                data["geometry"] = gdf_edges.loc[(u, v, k), "geometry"]
-            H.add_edge(u2, v2, **data)
+                # straight line between the original nodes
+                data["geometry"] = shp.geometry.LineString([
+                    (G.nodes[u]["x"], G.nodes[u]["y"]),
+                    (G.nodes[v]["x"], G.nodes[v]["y"])
+                ])
+            new_edges.append((u2, v2, data))
+    H.add_edges_from(new_edges)
 
     # STEP 7
     # for every group of merged nodes with more than 1 node in it, extend the
     # edge geometries to reach the new node point
-    for cluster_label, nodes_subset in groups:
+    # but only if there were multiple nodes merged together,
+    # otherwise it's the same old edge as in original graph
+    cluster_sizes = gdf["cluster"].value_counts()
+    merged = set(cluster_sizes.index[cluster_sizes > 1])
+    edges_to_extend = [
+        (u, v, data) for u, v, data in H.edges(data=True)
+        if u in merged or v in merged
+    ]
+    if len(edges_to_extend) == 0:
+        return H
 
-        # but only if there were multiple nodes merged together,
-        # otherwise it's the same old edge as in original graph
-        if len(nodes_subset) > 1:
-
-            # get coords of merged nodes point centroid to prepend or
-            # append to the old edge geom's coords
-            x = H.nodes[cluster_label]["x"]
-            y = H.nodes[cluster_label]["y"]
-            xy = [(x, y)]
-
-            # for each edge incident on this new merged node, update its
-            # geometry to extend to/from the new node's point coords
-            in_edges = set(H.in_edges(cluster_label, keys=True))
-            out_edges = set(H.out_edges(cluster_label, keys=True))
-            for u, v, k in in_edges | out_edges:
-                old_coords = list(H.edges[u, v, k]["geometry"].coords)
-                new_coords = xy + old_coords if cluster_label == u else old_coords + xy
-                new_geom = shp.ops.LineString(new_coords)
-                H.edges[u, v, k]["geometry"] = new_geom
-
-                # update the edge length attribute, given the new geometry
-                H.edges[u, v, k]["length"] = new_geom.length
+    # prepend the merged node point at the start and/or append it at the end of each edge geometry,
+    # working on one coordinate array for all edges
+    n_edges = len(edges_to_extend)
+    prepend = np.array([u in merged for u, v, data in edges_to_extend])
+    append = np.array([v in merged and u != v for u, v, data in edges_to_extend])
+    u_xy = np.array([(H.nodes[u]["x"], H.nodes[u]["y"]) for u, v, data in edges_to_extend], dtype=float)
+    v_xy = np.array([(H.nodes[v]["x"], H.nodes[v]["y"]) for u, v, data in edges_to_extend], dtype=float)
+    geometries = np.array([data["geometry"] for u, v, data in edges_to_extend], dtype=object)
+
+    coords, coords_edge = shp.get_coordinates(geometries, return_index=True)
+    old_counts = np.bincount(coords_edge, minlength=n_edges)
+    old_offsets = np.concatenate([[0], np.cumsum(old_counts)[:-1]])
+    new_counts = old_counts + prepend + append
+    new_offsets = np.concatenate([[0], np.cumsum(new_counts)[:-1]])
+
+    new_coords = np.empty((new_counts.sum(), 2))
+    position_in_edge = np.arange(len(coords)) - old_offsets[coords_edge]
+    new_coords[new_offsets[coords_edge] + prepend[coords_edge] + position_in_edge] = coords
+    new_coords[new_offsets[prepend]] = u_xy[prepend]
+    new_coords[new_offsets[append] + new_counts[append] - 1] = v_xy[append]
+
+    new_geometries = shp.linestrings(new_coords, indices=np.repeat(np.arange(n_edges), new_counts))
+    # update the edge length attribute, given the new geometry
+    new_lengths = shp.length(new_geometries)
+    for (u, v, data), geometry, length in zip(edges_to_extend, new_geometries, new_lengths.tolist()):
+        data["geometry"] = geometry
+        data["length"] = length
 
     return H
+
+
+def _intersections_containing_nodes(G, intersections_gdf, nodes):
+    """
+    Select the intersection geometries that contain at least one of the given nodes
+
+    Parameters
+    ----------
+    G : nx.MultiGraph or nx.MultiDiGraph
+        street graph
+    intersections_gdf : gpd.GeoDataFrame
+        intersection geometries
+    nodes : iterable
+        node ids
+
+    Returns
+    -------
+    gpd.GeoDataFrame
+    """
+
+    nodes = [node for node in nodes if node in G]
+    points = shp.points([(G.nodes[node]['x'], G.nodes[node]['y']) for node in nodes])
+    node_idx, intersection_idx = intersections_gdf.sindex.query(points, predicate='within')
+    return intersections_gdf.iloc[np.unique(intersection_idx)]
+
+
+def prepare_intersections(
+        G, tolerance, given_intersections_gdf=None, regions_gdf=None,
+        separate_layers=True, max_iterations=10, cpus=1
+):
+    """
+    Detect the intersection geometries and prepare the street graph for consolidating them:
+    split edges passing through the intersections and connect components within the intersections.
+
+    The stages are repeated until nothing changes anymore, because new nodes and connections can change the
+    intersection geometries. After the first pass, only the intersections containing nodes that have changed
+    in the previous pass are processed again.
+
+    Parameters
+    ----------
+    G : nx.MultiDiGraph or nx.MultiGraph
+        street graph
+    tolerance : int
+        radius of circles around the nodes
+    given_intersections_gdf : gpd.GeoDataFrame
+        explicitly defined intersection geometries,
+        created by .io.load_intersections()
+    regions_gdf : gpd.GeoDataFrame
+        simplification regions,
+        created by .io.load_regions()
+    separate_layers : bool
+        avoid connecting components that are on different layers (e.g., intersections above each other)
+    max_iterations : int
+        upper limit for the number of passes
+    cpus : int
+        how many CPU cores to use; if None, use all available
+
+    Returns
+    -------
+    intersections_gdf : gpd.GeoDataFrame
+        intersection geometries, ready to be used in consolidate_intersections()
+    """
+
+    def detect_intersections():
+        return merge_nodes_geometric(
+            G, tolerance,
+            given_intersections_gdf=given_intersections_gdf,
+            regions_gdf=regions_gdf,
+            cpus=cpus
+        )
+
+    graph_tools.update_precalculated_attributes(G)
+    intersections_gdf = detect_intersections()
+    changed_nodes = None
+
+    for i in range(max_iterations):
+
+        if changed_nodes is None:
+            intersections_to_split = intersections_gdf
+        else:
+            intersections_to_split = _intersections_containing_nodes(G, intersections_gdf, changed_nodes)
+        new_nodes = graph_tools.split_through_edges_in_intersections(G, intersections_to_split)
+
+        graph_tools._add_layers_to_nodes(G)
+        graph_tools.update_precalculated_attributes(G)
+        intersections_gdf = detect_intersections()
+
+        if changed_nodes is None:
+            intersections_to_connect = intersections_gdf
+        else:
+            intersections_to_connect = _intersections_containing_nodes(
+                G, intersections_gdf, changed_nodes | set(new_nodes)
+            )
+        new_edges = graph_tools.connect_components_in_intersections(
+            G, intersections_to_connect, separate_layers=separate_layers, cpus=cpus
+        )
+
+        changed_nodes = set(new_nodes) | {node for edge in new_edges for node in edge[0:2]}
+        # stop as soon as a fixed point is reached
+        if len(changed_nodes) == 0:
+            break
+
+        # the new connections change the street counts of their nodes and thereby the intersection geometries
+        graph_tools.update_precalculated_attributes(G)
+        intersections_gdf = detect_intersections()
+
+    return intersections_gdf
+
+
+def merge_parallel_and_consecutive_edges(G, max_offset=None, max_iterations=100):
+    """
+    Merge parallel and consecutive edges until nothing changes anymore.
+    Merging parallel edges can create new degree=2 nodes, and merging consecutive edges can create new parallel edges,
+    so after the first pass, only the nodes that have changed in the previous step are revisited.
+
+    Parameters
+    ----------
+    G : nx.MultiGraph
+        street graph
+    max_offset : float
+        see merge_edges.merge_parallel_edges()
+    max_iterations : int
+        upper limit for the number of passes
+
+    Returns
+    -------
+    counts : dict
+        total number of merged edges for parallel ('parallel') and consecutive ('consecutive') edges,
+        and the number of passes ('iterations')
+    """
+
+    counts = {'parallel': 0, 'consecutive': 0, 'iterations': 0}
+    nodes = None
+
+    for i in range(max_iterations):
+        parallel = merge_edges.merge_parallel_edges(G, max_offset=max_offset, nodes=nodes)
+        consecutive = merge_edges.merge_consecutive_edges(
+            G, nodes=None if nodes is None else nodes | parallel['changed_nodes']
+        )
+        counts['parallel'] += parallel['merged_edges']
+        counts['consecutive'] += consecutive['merged_edges']
+        counts['iterations'] += 1
+
+        # stop as soon as a fixed point is reached
+        if parallel['merged_edges'] == 0 and consecutive['merged_edges'] == 0:
+            break
+
+        nodes = parallel['changed_nodes'] | consecutive['changed_nodes']
+
+    return counts
@@ -0,0 +1,102 @@
+import geopandas as gpd
+import networkx as nx
+from shapely.geometry import LineString, Point, box
+
+from snman import graph_tools, lanes
+
+
+def _add_edge(G, u, v, **attributes):
+    geometry = LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])])
+    return G.add_edge(u, v, geometry=geometry, length=geometry.length, **attributes)
+
+
+def test_connect_components_in_intersections_keeps_python_node_ids():
+    # two separate edges within one intersection
+    G = nx.MultiGraph(crs=2056)
+    for node, x in [(5, 0.0), (6, 10.0), (100, 12.0), (101, 20.0)]:
+        G.add_node(node, x=x, y=0.0, street_count=2, highway=None)
+    _add_edge(G, 5, 6)
+    _add_edge(G, 100, 101)
+    intersections = gpd.GeoDataFrame(geometry=[box(-1, -1, 21, 1)], crs=2056)
+
+    new_edges = graph_tools.connect_components_in_intersections(G, intersections, separate_layers=False)
+
+    assert new_edges == [(6, 100, 0)]
+    assert all(type(u) is int and type(v) is int for u, v, key in new_edges)
+    assert all(type(node) is int for node in G.nodes)
+    assert all(type(node) is int for node in G._adj[6])
+
+
+def _straight_edge_graph():
+    G = nx.MultiGraph(crs=2056)
+    G.add_node(1, x=0.0, y=0.0)
+    G.add_node(2, x=10.0, y=0.0)
+    _add_edge(G, 1, 2, ln_desc=['M>', 'P<'], sensors_forward=['s1'], sensors_backward=[])
+    return G
+
+
+def test_split_edge_at_one_point():
+    G = _straight_edge_graph()
+
+    new_nodes = graph_tools._split_edge(G, 1, 2, 0, Point(4, 0.5))
+
+    # the new node is snapped onto the line and the edge is replaced by two child edges ending at the new node
+    assert new_nodes == [3]
+    assert (G.nodes[3]['x'], G.nodes[3]['y']) == (4.0, 0.0)
+    assert sorted(G.edges(keys=True)) == [(1, 3, 0), (2, 3, 0)]
+
+    first = G.edges[1, 3, 0]
+    assert list(first['geometry'].coords) == [(0.0, 0.0), (4.0, 0.0)]
+    assert first['length'] == 4.0
+    assert first['_split'] == 1
+    assert first['ln_desc'] == ['M>', 'P<']
+
+    # the second child runs from the higher to the lower node id, so it is reversed like before
+    second = G.edges[2, 3, 0]
+    assert list(second['geometry'].coords) == [(10.0, 0.0), (4.0, 0.0)]
+    assert second['length'] == 6.0
+    assert second['_split'] == 2
+    assert second['ln_desc'] == lanes._reverse_lanes(['M>', 'P<'])
+    assert second['sensors_backward'] == ['s1']
+
+    # the children do not share their lists
+    first['sensors_forward'].append('s2')
+    assert second['sensors_backward'] == ['s1']
+
+
+def test_split_edge_at_several_points():
+    G = _straight_edge_graph()
+
+    new_nodes = graph_tools._split_edge(G, 1, 2, 0, [Point(7, 0), Point(3, 0)])
+
+    assert new_nodes == [3, 4]
+    assert [G.nodes[node]['x'] for node in new_nodes] == [3.0, 7.0]
+    assert sorted(G.edges(keys=True)) == [(1, 3, 0), (2, 4, 0), (3, 4, 0)]
+    assert [G.edges[edge]['length'] for edge in [(1, 3, 0), (3, 4, 0), (2, 4, 0)]] == [3.0, 4.0, 3.0]
+    assert [G.edges[edge]['_split'] for edge in [(1, 3, 0), (3, 4, 0), (2, 4, 0)]] == [1, 2, 3]
+
+
+def test_split_edge_ignores_points_at_the_ends():
+    G = _straight_edge_graph()
+
+    assert graph_tools._split_edge(G, 1, 2, 0, [Point(0.5, 0), Point(9.5, 1)]) == []
+    assert list(G.edges(keys=True)) == [(1, 2, 0)]
+    assert graph_tools._split_edge(G, 1, 2, 1, Point(5, 0)) == []
+
+
+def test_add_connected_component_ids_to_directed_graph():
+    # a cycle 1-2-3 with a one-way edge to 4, and a separate edge 5-6
+    G = nx.MultiDiGraph(crs=2056)
+    G.add_edges_from([(1, 2), (2, 3), (3, 1), (3, 4), (5, 6)])
+
+    graph_tools.add_connected_component_ids(G)
+
+    weak = {(u, v): data['_weakly_connected_component'] for u, v, data in G.edges(data=True)}
+    assert len({weak[1, 2], weak[2, 3], weak[3, 1], weak[3, 4]}) == 1
+    assert weak[5, 6] != weak[1, 2]
+
+    # edges between different strongly connected components do not get the attribute
+    strong = {(u, v): data.get('_strongly_connected_component') for u, v, data in G.edges(data=True)}
+    assert len({strong[1, 2], strong[2, 3], strong[3, 1]}) == 1
+    assert '_strongly_connected_component' not in G.edges[3, 4, 0]
+    assert '_strongly_connected_component' not in G.edges[5, 6, 0]
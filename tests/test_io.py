@@ -0,0 +1,307 @@
+import glob
+import gzip
+import json
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import geopandas as gpd
+import networkx as nx
+import pandas as pd
+import pyproj
+import pytest
+from shapely.geometry import LineString, Point, box
+
+from snman import io
+
+
+def _write_points(path):
+    # points in WGS84 around Zurich, the perimeters are in the default target crs 2056
+    gdf = gpd.GeoDataFrame(
+        {'id': [1, 2, 3], 'name': ['a', 'b', 'c']},
+        geometry=[Point(8.54, 47.37), Point(8.55, 47.38), Point(8.7, 47.5)],
+        crs=4326
+    )
+    gdf.to_file(path)
+
+
+def test_import_geofile_with_perimeter(tmp_path):
+    path = str(tmp_path / 'points.gpkg')
+    _write_points(path)
+    perimeter = gpd.GeoDataFrame({'perimeter': ['p']}, geometry=[box(2682000, 1246000, 2685000, 1250000)], crs=2056)
+
+    gdf = io.import_geofile_to_gdf(path, perimeter=perimeter, columns=['name'])
+
+    assert sorted(gdf['name']) == ['a', 'b']
+    assert gdf.crs.to_epsg() == 2056
+
+
+def test_import_geofile_with_perimeter_without_crs(tmp_path):
+    path = str(tmp_path / 'points.gpkg')
+    _write_points(path)
+    perimeter = gpd.GeoDataFrame({'perimeter': ['p']}, geometry=[box(2682000, 1246000, 2685000, 1250000)])
+
+    gdf = io.import_geofile_to_gdf(path, perimeter=perimeter)
+
+    assert sorted(gdf['name']) == ['a', 'b']
+
+
+def _street_graph():
+    G = nx.MultiGraph(crs=2056)
+    G.add_node(1, x=2683000.0, y=1248000.0)
+    G.add_node(2, x=2683100.0, y=1248000.0)
+    G.add_node(3, x=2683100.0, y=1248100.0)
+    G.add_edge(
+        1, 2, geometry=LineString([(2683000, 1248000), (2683050, 1248020), (2683100, 1248000)]),
+        highway='primary', name='Main & "Street"'
+    )
+    G.add_edge(2, 3, geometry=LineString([(2683100, 1248000), (2683100, 1248100)]), highway='service')
+    return G
+
+
+def _read_osm_xml(file):
+    root = ET.parse(file).getroot()
+    nodes = {
+        int(node.get('id')): (float(node.get('lon')), float(node.get('lat')), len(node.findall('tag')))
+        for node in root.findall('node')
+    }
+    ways = [
+        (
+            [int(nd.get('ref')) for nd in way.findall('nd')],
+            {tag.get('k'): tag.get('v') for tag in way.findall('tag')}
+        )
+        for way in root.findall('way')
+    ]
+    return nodes, ways
+
+
+@pytest.mark.parametrize('file_name', ['graph.osm', 'graph.osm.gz'])
+def test_export_osm_xml(tmp_path, file_name):
+    G = _street_graph()
+    path = str(tmp_path / file_name)
+
+    io.export_osm_xml(G, path, ['highway', 'name', 'maxspeed'], uv_tags=True)
+
+    with (gzip.open(path) if file_name.endswith('.gz') else open(path, 'rb')) as file:
+        nodes, ways = _read_osm_xml(file)
+
+    # the graph nodes and one intermediary node, all reprojected to WGS84
+    assert len(nodes) == 4
+    project = pyproj.Transformer.from_crs(2056, 4326, always_xy=True).transform
+    assert nodes[1][:2] == pytest.approx(project(2683000.0, 1248000.0))
+
+    # one way per edge, from its u node over the intermediary nodes to its v node, tags that are None are skipped
+    assert len(ways) == 2
+    (refs_1, tags_1), (refs_2, tags_2) = ways
+    assert refs_1[0] == 1 and refs_1[-1] == 2 and len(refs_1) == 3
+    assert nodes[refs_1[1]][:2] == pytest.approx(project(2683050.0, 1248020.0))
+    assert refs_2 == [2, 3]
+    assert tags_1 == {'highway': 'primary', 'name': 'Main & "Street"', '_u': '1', '_v': '2', '_key': '0'}
+    assert tags_2 == {'highway': 'service', '_u': '2', '_v': '3', '_key': '0'}
+
+    # new ids do not collide with the graph node ids
+    assert refs_1[1] not in G.nodes
+
+
+def test_export_osm_xml_tag_all_nodes(tmp_path):
+    path = str(tmp_path / 'graph.osm')
+
+    io.export_osm_xml(_street_graph(), path, ['highway'], tag_all_nodes=True)
+
+    nodes, ways = _read_osm_xml(path)
+    assert all(n_tags == 1 for lon, lat, n_tags in nodes.values())
+
+
+def test_export_osm_pbf_has_the_same_content_as_xml(tmp_path):
+    osmium = pytest.importorskip('osmium')
+    G = _street_graph()
+    io.export_osm_xml(G, str(tmp_path / 'graph.osm'), ['highway', 'name'])
+    io.export_osm_pbf(G, str(tmp_path / 'graph.osm.pbf'), ['highway', 'name'])
+
+    def read(path):
+        nodes = {}
+        ways = []
+        for obj in osmium.FileProcessor(path):
+            if obj.is_node():
+                nodes[obj.id] = (round(obj.location.lon, 7), round(obj.location.lat, 7))
+            elif obj.is_way():
+                ways.append(([nd.ref for nd in obj.nodes], {tag.k: tag.v for tag in obj.tags}))
+        return nodes, ways
+
+    assert read(str(tmp_path / 'graph.osm.pbf')) == read(str(tmp_path / 'graph.osm'))
+
+
+@pytest.fixture
+def cached_loader(tmp_path, monkeypatch):
+    monkeypatch.setattr(io, 'cache_folder', str(tmp_path / 'cache'))
+    calls = []
+
+    @io._cached_input
+    def load(path, factor=1, options=None):
+        calls.append(path)
+        with open(path) as file:
+            return int(file.read()) * factor
+
+    return load, calls
+
+
+def test_cached_input_reuses_results(tmp_path, cached_loader):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+
+    assert load(str(path)) == 2
+    assert load(str(path), factor=1) == 2
+    assert load(str(path), 1, None) == 2
+    assert len(calls) == 1
+
+
+def test_cached_input_is_invalidated(tmp_path, cached_loader):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+    load(str(path))
+
+    # other arguments
+    assert load(str(path), factor=3) == 6
+    assert len(calls) == 2
+
+    # the file changes
+    path.write_text('40')
+    assert load(str(path)) == 40
+    assert len(calls) == 3
+    stat = os.stat(path)
+    path.write_text('50')
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert load(str(path)) == 50
+    assert len(calls) == 4
+
+
+def test_cached_input_recomputes_unreadable_files(tmp_path, cached_loader):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+    load(str(path))
+
+    cache_file, = glob.glob(os.path.join(io.cache_folder, '*.pkl'))
+    with open(cache_file, 'wb') as file:
+        file.write(b'\x80\x05broken')
+
+    assert load(str(path)) == 2
+    assert len(calls) == 2
+    assert load(str(path)) == 2
+    assert len(calls) == 2
+
+
+def test_cached_input_skips_arguments_without_fingerprint(tmp_path, cached_loader, monkeypatch):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+
+    load(str(path), options=object())
+    load(str(path), options=object())
+    assert len(calls) == 2
+
+    # no caching without cache folder
+    monkeypatch.setattr(io, 'cache_folder', None)
+    load(str(path))
+    load(str(path))
+    assert len(calls) == 4
+
+
+def test_cached_input_evicts_least_recently_used_files(tmp_path, cached_loader, monkeypatch):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+    load(str(path), factor=1)
+    size = os.path.getsize(glob.glob(os.path.join(io.cache_folder, '*.pkl'))[0])
+    monkeypatch.setattr(io, 'cache_size_limit', 2 * size)
+
+    for factor in [2, 3, 4]:
+        # file modification times are not exact
+        time.sleep(0.05)
+        load(str(path), factor=factor)
+
+    assert len(glob.glob(os.path.join(io.cache_folder, '*.pkl'))) == 2
+    load(str(path), factor=4)
+    assert len(calls) == 4
+
+
+def test_cached_input_removes_stale_temporary_files(tmp_path, cached_loader):
+    load, calls = cached_loader
+    path = tmp_path / 'input.txt'
+    path.write_text('2')
+    os.makedirs(io.cache_folder)
+    stale = os.path.join(io.cache_folder, 'stale.tmp')
+    recent = os.path.join(io.cache_folder, 'recent.tmp')
+    for temporary_path in [stale, recent]:
+        with open(temporary_path, 'wb') as file:
+            file.write(b'partial')
+    old = time.time() - io._CACHE_STALE_TEMPORARY_AGE - 60
+    os.utime(stale, (old, old))
+
+    load(str(path))
+
+    # the recent file may still be written by another process
+    assert not os.path.exists(stale)
+    assert os.path.exists(recent)
+
+
+def test_json_column_keeps_values():
+    values = [
+        [1, 2], ['a', 'b/c', 'ä\n'], [True], [], None, {'a': 0.123456789012345}, [[0.1, 2]], [0.123456789012345]
+    ]
+    for value in values:
+        series = pd.Series([value, value], dtype=object)
+        assert [json.loads(encoded) for encoded in io._json_column(series)] == [value, value]
+
+
+def test_convert_crs_of_street_graph_with_2d_and_3d_geometries():
+    G = _street_graph()
+    G.add_node(4, x=2683200.0, y=1248100.0)
+    G.add_edge(3, 4, geometry=LineString([(2683100, 1248100, 400), (2683200, 1248100, 410)]))
+    G.add_edge(1, 3)
+
+    io.convert_crs_of_street_graph(G, 4326)
+
+    project = pyproj.Transformer.from_crs(2056, 4326, always_xy=True).transform
+    assert G.graph['crs'].to_epsg() == 4326
+    assert (G.nodes[1]['x'], G.nodes[1]['y']) == pytest.approx(project(2683000.0, 1248000.0))
+    two_dimensional = G.edges[1, 2, 0]['geometry']
+    assert not two_dimensional.has_z
+    assert two_dimensional.coords[1] == pytest.approx(project(2683050.0, 1248020.0))
+    three_dimensional = G.edges[3, 4, 0]['geometry']
+    assert three_dimensional.has_z
+    assert [z for x, y, z in three_dimensional.coords] == [400.0, 410.0]
+    assert 'geometry' not in G.edges[1, 3, 0]
+
+
+def _lanes_graph():
+    G = _street_graph()
+    G.edges[1, 2, 0]['ln_desc'] = ['M<', 'M>', 'P>']
+    G.edges[2, 3, 0]['ln_desc'] = ['L-']
+    G.add_edge(1, 3, geometry=LineString([(2683000, 1248000), (2683100, 1248100)]), ln_desc=[])
+    return G
+
+
+def test_lane_chunks_are_limited_in_size():
+    chunks = list(io._lane_chunks(_lanes_graph(), 'ln_desc', chunk_size=3))
+
+    assert [len(distances) for columns, distances in chunks] == [3, 1]
+    assert [columns['descr'] for columns, distances in chunks] == [['M<', 'M>', 'P>'], ['L-']]
+    # the lanes of an edge are placed symmetrically around its centerline
+    assert chunks[1][1].tolist() == [0]
+    assert chunks[0][1][0] < 0 < chunks[0][1][2]
+
+
+@pytest.mark.parametrize('cpus', [1, 2])
+def test_export_street_graph_with_lanes_in_chunks(tmp_path, cpus):
+    G = _lanes_graph()
+    io.export_street_graph_with_lanes(G, 'ln_desc', str(tmp_path / 'lanes.gpkg'))
+    io.export_street_graph_with_lanes(G, 'ln_desc', str(tmp_path / 'chunks.gpkg'), cpus=cpus, chunk_size=1)
+
+    lanes = gpd.read_file(str(tmp_path / 'lanes.gpkg'))
+    chunks = gpd.read_file(str(tmp_path / 'chunks.gpkg'))
+    assert lanes['descr'].tolist() == ['M<', 'M>', 'P>', 'L-']
+    assert chunks.drop(columns='geometry').equals(lanes.drop(columns='geometry'))
+    assert chunks.geometry.geom_equals_exact(lanes.geometry, 1e-9).all()
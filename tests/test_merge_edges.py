@@ -0,0 +1,118 @@
+import networkx as nx
+from shapely.geometry import LineString
+
+from snman import merge_edges
+
+
+def _graph(chain, ln_desc=None):
+    """
+    Street graph with a chain of edges from node 1 to node 2 along the x axis, both ends have two more streets
+    """
+
+    G = nx.MultiGraph(crs=2056)
+    for node, x, y in [
+        (1, 0.0, 0.0), (2, 10.0, 0.0), (5, 0.0, -10.0), (6, -10.0, 0.0), (7, 10.0, 10.0), (8, 20.0, 0.0)
+    ]:
+        G.add_node(node, x=x, y=y)
+    for i, node in enumerate(chain[1:-1]):
+        G.add_node(node, x=10.0 * (i + 1) / (len(chain) - 1), y=0.0)
+
+    def add_edge(u, v, **attributes):
+        geometry = LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])])
+        attributes = {'ln_desc': ['m>'], 'sensors_forward': [], 'sensors_backward': [], **attributes}
+        G.add_edge(u, v, geometry=geometry, length=geometry.length, **attributes)
+
+    for u, v in [(1, 5), (1, 6), (2, 7), (2, 8)]:
+        add_edge(u, v)
+    for i, (u, v) in enumerate(zip(chain[:-1], chain[1:])):
+        add_edge(u, v, ln_desc=ln_desc[i] if ln_desc else ['m>'], sensors_forward=[f's{i}'])
+    return G
+
+
+def test_merge_long_chain_at_once():
+    G = _graph([1, 10, 11, 12, 13, 14, 2])
+    # one edge with its geometry running against the chain
+    G.edges[11, 12, 0]['geometry'] = G.edges[11, 12, 0]['geometry'].reverse()
+
+    counts = merge_edges.merge_consecutive_edges(G)
+
+    assert (counts['chains'], counts['merged_edges'], counts['removed_nodes']) == (1, 6, 5)
+    assert counts['changed_nodes'] == {1, 2}
+    assert sorted(G.nodes) == [1, 2, 5, 6, 7, 8]
+    data = G.edges[1, 2, 0]
+    assert list(data['geometry'].coords) == [(0.0, 0.0)] + [(10 * i / 6, 0.0) for i in range(1, 6)] + [(10.0, 0.0)]
+    assert data['length'] == 10.0
+    assert data['__nodes'] == str([1, 10, 11, 12, 13, 14, 2])
+    # the sensors of the reversed edge are reversed as well
+    assert sorted(data['sensors_forward']) == ['s0', 's1', 's3', 's4', 's5']
+    assert data['sensors_backward'] == ['s2']
+
+
+def test_merge_chain_oriented_from_lower_to_higher_node():
+    # the geometries of two edges run from node 2 towards node 1
+    G = _graph([1, 20, 10, 2])
+    for u, v in [(10, 20), (2, 10)]:
+        G.edges[u, v, 0]['geometry'] = G.edges[u, v, 0]['geometry'].reverse()
+
+    merge_edges.merge_consecutive_edges(G)
+
+    coords = list(G.edges[1, 2, 0]['geometry'].coords)
+    assert coords[0] == (0.0, 0.0) and coords[-1] == (10.0, 0.0)
+    assert G.edges[1, 2, 0]['__outer_nodes'] == str([1, 2])
+
+
+def test_merge_chain_split_by_motorized_access():
+    G = _graph([1, 10, 11, 12, 2], ln_desc=[['m>'], ['m>'], ['P-'], ['P-']])
+
+    counts = merge_edges.merge_consecutive_edges(G)
+
+    # node 11 separates the motorized from the non-motorized part and is kept
+    assert (counts['chains'], counts['merged_edges'], counts['removed_nodes']) == (2, 4, 2)
+    assert sorted(G.edges(keys=True)) == [(1, 5, 0), (1, 6, 0), (1, 11, 0), (2, 7, 0), (2, 8, 0), (2, 11, 0)]
+
+
+def test_merge_chains_of_given_nodes_only():
+    G = _graph([1, 10, 11, 2])
+    # a separate chain between two dead ends
+    for node, x in [(30, 0.0), (31, 5.0), (32, 10.0)]:
+        G.add_node(node, x=x, y=20.0)
+    for u, v in [(30, 31), (31, 32)]:
+        geometry = LineString([(G.nodes[u]['x'], 20.0), (G.nodes[v]['x'], 20.0)])
+        G.add_edge(u, v, geometry=geometry, length=geometry.length, ln_desc=['m>'])
+
+    merge_edges.merge_consecutive_edges(G, nodes=[11])
+
+    assert 10 not in G and 11 not in G
+    assert 31 in G
+
+
+def _parallel_graph():
+    # two carriageways of the same street and a street around the block, all between nodes 1 and 2
+    G = nx.MultiGraph(crs=2056)
+    G.add_node(1, x=0.0, y=0.0)
+    G.add_node(2, x=100.0, y=0.0)
+    for y, ln_desc in [(5, ['M>']), (-5, ['M<']), (80, ['M-'])]:
+        geometry = LineString([(0, 0), (20, y), (80, y), (100, 0)])
+        G.add_edge(
+            1, 2, geometry=geometry, length=geometry.length, ln_desc=ln_desc, hierarchy=1,
+            sensors_forward=[], sensors_backward=[]
+        )
+    return G
+
+
+def test_merge_parallel_edges_within_max_offset():
+    G = _parallel_graph()
+
+    counts = merge_edges.merge_parallel_edges(G, max_offset=30)
+
+    assert (counts['groups'], counts['merged_edges']) == (1, 2)
+    assert sorted(sorted(data['ln_desc']) for u, v, data in G.edges(data=True)) == [['M-'], ['M<', 'M>']]
+
+
+def test_merge_parallel_edges_without_max_offset():
+    G = _parallel_graph()
+
+    counts = merge_edges.merge_parallel_edges(G)
+
+    assert (counts['groups'], counts['merged_edges']) == (1, 3)
+    assert G.number_of_edges() == 1
@@ -0,0 +1,40 @@
+import geopandas as gpd
+import networkx as nx
+from shapely.geometry import LineString, box
+
+from snman import simplification
+
+
+def _add_edge(G, u, v, **attributes):
+    geometry = LineString([(G.nodes[u]['x'], G.nodes[u]['y']), (G.nodes[v]['x'], G.nodes[v]['y'])])
+    return G.add_edge(u, v, geometry=geometry, length=geometry.length, **attributes)
+
+
+def test_consolidate_intersections_splits_clusters_into_components():
+    # nodes 1, 2 and 3 are within the same intersection, but 3 is not connected to 1 and 2 within it
+    G = nx.MultiDiGraph(crs=2056)
+    for node, x, y in [(1, 0.0, 0.0), (2, 2.0, 0.0), (3, 0.0, 3.0), (4, 10.0, 0.0), (5, 0.0, 10.0)]:
+        G.add_node(node, x=x, y=y, street_count=2, highway=None)
+    _add_edge(G, 1, 2)
+    _add_edge(G, 2, 4)
+    _add_edge(G, 3, 5)
+    intersections = gpd.GeoDataFrame(
+        geometry=[box(-1, -1, 3, 4), box(9, -1, 11, 1), box(-1, 9, 1, 11)], crs=2056
+    )
+
+    H = simplification.consolidate_intersections(G, intersections)
+
+    # 1 and 2 are merged at their centroid, 3 keeps its own node
+    nodes = {data['osmid_original']: (data['x'], data['y']) for node, data in H.nodes(data=True)}
+    assert nodes == {'[1, 2]': (1.0, 0.0), 3: (0.0, 3.0), 4: (10.0, 0.0), 5: (0.0, 10.0)}
+
+    # the edge within the merged node is removed, the edge leaving it is extended to the merged node
+    edges = {
+        (data['u_original'], data['v_original']): list(data['geometry'].coords)
+        for u, v, data in H.edges(data=True)
+    }
+    assert edges == {
+        (2, 4): [(1.0, 0.0), (2.0, 0.0), (10.0, 0.0)],
+        (3, 5): [(0.0, 3.0), (0.0, 10.0)],
+    }
+    assert sorted(data['length'] for u, v, data in H.edges(data=True)) == [7.0, 9.0]
@@ -0,0 +1,54 @@
+import networkx as nx
+import numpy as np
+import pytest
+from shapely.geometry import LineString
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pytest.skip("pyarrow is not available", allow_module_level=True)
+
+from snman import io
+
+
+def _graph():
+    # mix python floats and numpy scalars, as produced by the simplification pipeline
+    G = nx.MultiGraph(crs=2056)
+    G.add_node(1, x=2680000.0, y=np.float64(1240000.0))
+    G.add_node(2, x=np.float64(2680010.0), y=1240010.0)
+    geometry = LineString([(2680000.0, 1240000.0), (2680010.0, 1240010.0)])
+    G.add_edge(1, 2, geometry=geometry, length=np.float64(geometry.length), ln_desc=['M-', 'P>'])
+    return G
+
+
+def test_coordinates_and_lengths_are_primitive_arrays(tmp_path):
+    io.save_snapshot(_graph(), str(tmp_path))
+    node_table, edge_table = io.open_snapshot(str(tmp_path))
+
+    for table, column in [(node_table, 'x'), (node_table, 'y'), (edge_table, 'length')]:
+        assert pa.types.is_floating(table.schema.field(column).type)
+        assert table.schema.field(column).metadata[b'encoding'] == b'native'
+        assert isinstance(table[column].to_numpy(), np.ndarray)
+
+
+@pytest.mark.parametrize('memory_map', [True, False])
+def test_load_snapshot_round_trip(tmp_path, memory_map):
+    G = _graph()
+    io.save_snapshot(G, str(tmp_path))
+    H = io.load_snapshot(str(tmp_path), memory_map=memory_map)
+
+    assert dict(H.nodes(data=True)) == dict(G.nodes(data=True))
+    (u, v, data), = H.edges(data=True)
+    assert data['ln_desc'] == ['M-', 'P>']
+    assert data['length'] == G.edges[1, 2, 0]['length']
+    assert data['geometry'].equals(G.edges[1, 2, 0]['geometry'])
+
+
+def test_load_subgraph_with_numpy_ids(tmp_path):
+    G = _graph()
+    G.add_node(3, x=2680020.0, y=1240020.0)
+    io.save_snapshot(G, str(tmp_path))
+    H = io.load_snapshot(str(tmp_path), nodes=[np.int64(1), np.int64(2)], memory_map=True)
+
+    assert set(H.nodes) == {1, 2}
+    assert H.number_of_edges() == 1
@@ -0,0 +1,69 @@
+import random
+
+import networkx as nx
+import pytest
+from shapely.geometry import LineString
+
+from snman.osmnx_customized import utils_graph
+
+
+def _random_graph(seed):
+    """
+    Directed graph with reciprocal, parallel and differing edges, some of them without geometry
+    """
+
+    random.seed(seed)
+    G = nx.MultiDiGraph(crs=2056)
+    for node in range(20):
+        G.add_node(node, x=random.random() * 100, y=random.random() * 100)
+    for i in range(60):
+        u, v = random.randrange(20), random.randrange(20)
+        middle = (random.random() * 100, random.random() * 100)
+        geometry = LineString([(G.nodes[u]['x'], G.nodes[u]['y']), middle, (G.nodes[v]['x'], G.nodes[v]['y'])])
+        osmid = random.choice([i, [i, i + 1]])
+        data = {'osmid': osmid, 'name': i}
+        if random.random() < 0.8:
+            data['geometry'] = geometry
+        G.add_edge(u, v, **data)
+        # reciprocal edge with the same geometry in the opposite direction
+        if random.random() < 0.5:
+            reciprocal = dict(data, name=-i)
+            if 'geometry' in reciprocal:
+                reciprocal['geometry'] = geometry.reverse()
+            if isinstance(osmid, list):
+                reciprocal['osmid'] = osmid[::-1]
+            G.add_edge(v, u, **reciprocal)
+        # parallel edge with the same geometry
+        if random.random() < 0.1:
+            G.add_edge(u, v, **dict(data, name=i + 0.5))
+    return G
+
+
+def _signature(H):
+    return sorted(
+        (min(u, v), max(u, v), data['from'], data['to'], str(data['osmid']), data['geometry'].wkt, data['name'])
+        for u, v, data in H.edges(data=True)
+    )
+
+
+def test_get_undirected_merges_reciprocal_edges():
+    G = nx.MultiDiGraph(crs=2056)
+    G.add_node(1, x=0.0, y=0.0)
+    G.add_node(2, x=10.0, y=0.0)
+    geometry = LineString([(0, 0), (5, 5), (10, 0)])
+    G.add_edge(1, 2, osmid=1, geometry=geometry)
+    G.add_edge(2, 1, osmid=1, geometry=geometry.reverse())
+    # same nodes, but a different street
+    G.add_edge(2, 1, osmid=1, geometry=LineString([(10, 0), (5, -5), (0, 0)]))
+
+    for fast in [False, True]:
+        H = utils_graph.get_undirected(G, fast=fast)
+        assert isinstance(H, nx.MultiGraph) and not H.is_directed()
+        assert H.number_of_edges() == 2
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_get_undirected_fast_is_the_same_as_pairwise(seed):
+    G = _random_graph(seed)
+
+    assert _signature(utils_graph.get_undirected(G, fast=True)) == _signature(utils_graph.get_undirected(G))